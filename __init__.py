@@ -1,9 +1,19 @@
+import asyncio
+
 from fastapi import APIRouter
+from lnbits.tasks import create_permanent_unique_task, create_unique_task
+from loguru import logger
 
-from .crud import db
+from .backfill import online_backfills, run_online_backfills
+from .crud import bulk_db, db, get_withdraw_settings, withdraw_settings
+from .journal import run_attempt_journal
+from .lookup_filter import run_lookup_filter
+from .pool import run_pool_refill
+from .replica import replica_db, run_replica_monitor
 from .views import withdraw_ext_generic
 from .views_api import withdraw_ext_api
 from .views_lnurl import withdraw_ext_lnurl
+from .webhooks import run_webhook_digests
 
 withdraw_static_files = [
     {
@@ -17,4 +27,49 @@ withdraw_ext.include_router(withdraw_ext_generic)
 withdraw_ext.include_router(withdraw_ext_api)
 withdraw_ext.include_router(withdraw_ext_lnurl)
 
-__all__ = ["db", "withdraw_ext", "withdraw_static_files"]
+scheduled_tasks: list[asyncio.Task] = []
+
+
+def withdraw_stop():
+    for task in scheduled_tasks:
+        try:
+            task.cancel()
+        except Exception as ex:
+            logger.warning(ex)
+
+
+def withdraw_start():
+    task = create_unique_task("ext_withdraw_settings", get_withdraw_settings())
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task(
+        "ext_withdraw_attempt_journal", run_attempt_journal
+    )
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_withdraw_pool_refill", run_pool_refill)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task(
+        "ext_withdraw_webhook_digests", run_webhook_digests
+    )
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task(
+        "ext_withdraw_lookup_filter",
+        lambda: run_lookup_filter(bulk_db, withdraw_settings),
+    )
+    scheduled_tasks.append(task)
+    if online_backfills:
+        task = create_unique_task("ext_withdraw_backfills", run_online_backfills(db))
+        scheduled_tasks.append(task)
+    if replica_db:
+        task = create_permanent_unique_task(
+            "ext_withdraw_replica", lambda: run_replica_monitor(withdraw_settings)
+        )
+        scheduled_tasks.append(task)
+
+
+__all__ = [
+    "db",
+    "withdraw_ext",
+    "withdraw_start",
+    "withdraw_static_files",
+    "withdraw_stop",
+]
@@ -0,0 +1,142 @@
+import asyncio
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
+
+from lnbits.db import Connection, Database
+from loguru import logger
+
+# writes one batch of source rows, must be idempotent: a batch is run again when
+# the process stops between its writes and the checkpoint
+BackfillApply = Callable[[Connection, list[dict]], Awaitable[None]]
+
+BATCH_SIZE = 500
+# seconds between two batches of an online backfill, lets other queries through
+ONLINE_PAUSE = 0.1
+
+# backfills run by `run_online_backfills` after startup, for rewrites where the
+# code reads the old schema until `is_backfill_done` and the new one after
+online_backfills: list[tuple[str, str, BackfillApply]] = []
+
+
+@asynccontextmanager
+async def _connect(db: Database | Connection) -> AsyncIterator[Connection]:
+    if isinstance(db, Connection):
+        yield db
+    else:
+        async with db.connect() as conn:
+            yield conn
+
+
+async def _create_checkpoints(conn: Connection) -> None:
+    # created on first use, so migrations of any version can backfill
+    await conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS withdraw.backfill (
+            name TEXT PRIMARY KEY,
+            cursor TEXT NOT NULL DEFAULT '',
+            processed INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            done BOOLEAN NOT NULL DEFAULT false,
+            updated_at TIMESTAMP DEFAULT {conn.timestamp_column_default}
+        );
+        """
+    )
+
+
+async def backfill(
+    db: Database | Connection,
+    name: str,
+    source: str,
+    apply: BackfillApply,
+    key: str = "id",
+    batch_size: int = BATCH_SIZE,
+    pause: float = 0,
+) -> int:
+    """
+    Feed the rows of the `source` table to `apply` in batches ordered by the
+    TEXT column `key`, recording a checkpoint after every batch. An interrupted
+    run resumes after the last checkpoint, a finished one is not run again.
+
+    Inside a migration pass its connection. Pass the `Database` to run online:
+    every batch then takes its own connection, so requests are served between
+    batches. Returns the number of rows processed.
+    """
+    async with _connect(db) as conn:
+        await _create_checkpoints(conn)
+        row: dict | None = await conn.fetchone(
+            "SELECT * FROM withdraw.backfill WHERE name = :name", {"name": name}
+        )
+        if row and row["done"]:
+            return row["processed"]
+        if not row:
+            await conn.execute(
+                "INSERT INTO withdraw.backfill (name) VALUES (:name)", {"name": name}
+            )
+        after = row["cursor"] if row else ""
+        processed = row["processed"] if row else 0
+        pending: dict = await conn.fetchone(
+            f"SELECT COUNT(*) AS pending FROM {source} WHERE {key} > :after",
+            {"after": after},
+        )
+        total = processed + pending["pending"]
+        logger.info(f"withdraw backfill {name}: {processed}/{total} rows done.")
+
+    while True:
+        async with _connect(db) as conn:
+            rows: list[dict] = await conn.fetchall(
+                f"""
+                SELECT * FROM {source} WHERE {key} > :after
+                ORDER BY {key} LIMIT :limit
+                """,
+                {"after": after, "limit": batch_size},
+            )
+            if rows:
+                await apply(conn, rows)
+                after = rows[-1][key]
+                processed += len(rows)
+            done = len(rows) < batch_size
+            await conn.execute(
+                f"""
+                UPDATE withdraw.backfill SET cursor = :cursor,
+                processed = :processed, total = :total, done = :done,
+                updated_at = {conn.timestamp_now}
+                WHERE name = :name
+                """,
+                {
+                    "name": name,
+                    "cursor": after,
+                    "processed": processed,
+                    "total": max(total, processed),
+                    "done": done,
+                },
+            )
+        logger.debug(f"withdraw backfill {name}: {processed}/{total} rows.")
+        if done:
+            logger.info(f"withdraw backfill {name} finished, {processed} rows.")
+            return processed
+        if pause:
+            await asyncio.sleep(pause)
+
+
+async def is_backfill_done(db: Database | Connection, name: str) -> bool:
+    async with _connect(db) as conn:
+        await _create_checkpoints(conn)
+        row: dict | None = await conn.fetchone(
+            "SELECT done FROM withdraw.backfill WHERE name = :name", {"name": name}
+        )
+    return bool(row and row["done"])
+
+
+async def get_backfills(db: Database) -> list[dict]:
+    """Progress of all backfills, for `/api/v1/metrics`."""
+    async with db.connect() as conn:
+        await _create_checkpoints(conn)
+        rows = await conn.fetchall(
+            "SELECT name, processed, total, done FROM withdraw.backfill"
+        )
+    return [dict(row) for row in rows]
+
+
+async def run_online_backfills(db: Database) -> None:
+    for name, source, apply in online_backfills:
+        await backfill(db, name, source, apply, pause=ONLINE_PAUSE)
@@ -1,23 +1,57 @@
+from collections.abc import AsyncIterator, Sequence
 from datetime import datetime
 
 import shortuuid
-from lnbits.db import Database
+from lnbits.db import SQLITE, Connection, Database, model_to_dict
 from lnbits.helpers import urlsafe_short_hash
-
-from .models import CreateWithdrawData, HashCheck, PaginatedWithdraws, WithdrawLink
+from pydantic import BaseModel
+from sqlalchemy.sql import text
+
+from .helpers import resize_usescsv
+from .lookup_filter import (
+    add_unique_hash,
+    forget_unique_hashes,
+    might_exist,
+    note_false_positive,
+)
+from .models import (
+    CreateWithdrawData,
+    CreateWithdrawPoolData,
+    HashCheck,
+    WithdrawAttempt,
+    WithdrawLink,
+    WithdrawLinkFilters,
+    WithdrawLinkRow,
+    WithdrawPool,
+    WithdrawSettings,
+)
+from .replica import (
+    get_replica,
+    is_pinned,
+    pin_to_primary,
+    replica_enabled,
+    replica_stats,
+)
 
 db = Database("ext_withdraw")
+# second handle on the same database for listings, exports and attempts: its
+# own connection and lock, so bulk reads never hold the one redemptions wait for
+bulk_db = Database("ext_withdraw")
 
+# in-memory copy of the settings row, so hot paths can read it without a query
+withdraw_settings = WithdrawSettings()
 
-async def create_withdraw_link(
-    data: CreateWithdrawData, wallet_id: str
-) -> WithdrawLink:
+
+def _new_withdraw_link(data: CreateWithdrawData, wallet_id: str) -> WithdrawLink:
     link_id = urlsafe_short_hash()[:22]
     available_links = ",".join([str(i) for i in range(data.uses)])
+    unique_hash = urlsafe_short_hash()
+    # known to the lookup filter before the row exists, never rejected after
+    add_unique_hash(unique_hash)
     withdraw_link = WithdrawLink(
         id=link_id,
         wallet=wallet_id,
-        unique_hash=urlsafe_short_hash(),
+        unique_hash=unique_hash,
         k1=urlsafe_short_hash(),
         created_at=datetime.now(),
         open_time=int(datetime.now().timestamp()) + data.wait_time,
@@ -31,19 +65,49 @@ async def create_withdraw_link(
         webhook_url=data.webhook_url,
         webhook_headers=data.webhook_headers,
         webhook_body=data.webhook_body,
+        webhook_digest=data.webhook_digest,
         custom_url=data.custom_url,
         number=0,
     )
+    return withdraw_link
+
+
+async def create_withdraw_link(
+    data: CreateWithdrawData, wallet_id: str
+) -> WithdrawLink:
+    withdraw_link = _new_withdraw_link(data, wallet_id)
     await db.insert("withdraw.withdraw_link", withdraw_link)
+    _pin_wallet(wallet_id)
     return withdraw_link
 
 
-async def get_withdraw_link(link_id: str, num=0) -> WithdrawLink | None:
-    link = await db.fetchone(
-        "SELECT * FROM withdraw.withdraw_link WHERE id = :id",
-        {"id": link_id},
-        WithdrawLink,
-    )
+def _pin_wallet(wallet_id: str) -> None:
+    if replica_enabled():
+        pin_to_primary(wallet_id, withdraw_settings.replica_max_lag)
+
+
+async def _fetch_withdraw_link(
+    column: str, value: str, from_replica: bool
+) -> WithdrawLink | None:
+    query = f"SELECT * FROM withdraw.withdraw_link WHERE {column} = :value"
+    replica = get_replica() if from_replica else None
+    if replica:
+        link = await replica.fetchone(query, {"value": value}, WithdrawLink)
+        # a missing link may not be replicated yet, a pinned one is outdated
+        if link and not is_pinned(link.wallet):
+            return link
+        replica_stats["fallbacks"] += 1
+    return await db.fetchone(query, {"value": value}, WithdrawLink)
+
+
+async def get_withdraw_link(
+    link_id: str, num=0, from_replica: bool = False
+) -> WithdrawLink | None:
+    """
+    `from_replica` allows reading from the read replica, only for requests that
+    do not write the link afterwards.
+    """
+    link = await _fetch_withdraw_link("id", link_id, from_replica)
     if not link:
         return None
 
@@ -51,76 +115,321 @@ async def get_withdraw_link(link_id: str, num=0) -> WithdrawLink | None:
     return link
 
 
-async def get_withdraw_link_by_hash(unique_hash: str, num=0) -> WithdrawLink | None:
-    link = await db.fetchone(
-        "SELECT * FROM withdraw.withdraw_link WHERE unique_hash = :hash",
-        {"hash": unique_hash},
-        WithdrawLink,
-    )
+async def get_withdraw_link_by_hash(
+    unique_hash: str, num=0, from_replica: bool = False
+) -> WithdrawLink | None:
+    # scanners and stale clients ask for hashes that never existed
+    if not might_exist(unique_hash):
+        return None
+    link = await _fetch_withdraw_link("unique_hash", unique_hash, from_replica)
     if not link:
+        note_false_positive()
         return None
 
     link.number = num
     return link
 
 
-async def get_withdraw_links(
-    wallet_ids: list[str], limit: int, offset: int
-) -> PaginatedWithdraws:
-    q = ",".join([f"'{w}'" for w in wallet_ids])
+def _withdraw_links_where(
+    wallet_ids: list[str], filters: WithdrawLinkFilters
+) -> tuple[str, dict]:
+    values: dict = {f"wallet_{i}": w for i, w in enumerate(wallet_ids)}
+    # links waiting in a pool are not handed out yet
+    where = [
+        f"wallet IN ({', '.join(f':{key}' for key in values)})",
+        "pool_id IS NULL",
+    ]
+    if filters.title:
+        # `%` and `_` in the search match themselves, not any characters
+        where.append("lower(title) LIKE :title ESCAPE '\\'")
+        title = filters.title.lower()
+        for char in ("\\", "%", "_"):
+            title = title.replace(char, f"\\{char}")
+        values["title"] = f"%{title}%"
+    if filters.enabled is not None:
+        where.append("enabled = :enabled")
+        values["enabled"] = filters.enabled
+    if filters.spent is not None:
+        where.append("used >= uses" if filters.spent else "used < uses")
+    if filters.is_unique is not None:
+        # stored as INTEGER by the first migrations
+        where.append("is_unique = :is_unique")
+        values["is_unique"] = int(filters.is_unique)
+    if filters.amount_min is not None:
+        where.append("max_withdrawable >= :amount_min")
+        values["amount_min"] = filters.amount_min
+    if filters.amount_max is not None:
+        where.append("max_withdrawable <= :amount_max")
+        values["amount_max"] = filters.amount_max
+    if filters.created_from:
+        where.append(f"created_at >= {db.timestamp_placeholder('created_from')}")
+        values["created_from"] = filters.created_from
+    if filters.created_to:
+        where.append(f"created_at < {db.timestamp_placeholder('created_to')}")
+        values["created_to"] = filters.created_to
+    return " AND ".join(where), values
 
+
+async def get_withdraw_links(
+    wallet_ids: list[str],
+    limit: int,
+    offset: int,
+    filters: WithdrawLinkFilters | None = None,
+) -> tuple[list[WithdrawLinkRow], int]:
+    if not wallet_ids:
+        return [], 0
+    filters = filters or WithdrawLinkFilters()
+    clause, values = _withdraw_links_where(wallet_ids, filters)
+
+    # `sortby` is validated against a fixed list by `WithdrawLinkFilters`
+    sortby = "uses - used" if filters.sortby == "uses_left" else filters.sortby
     query_str = f"""
-        SELECT * FROM withdraw.withdraw_link WHERE wallet IN ({q})
-        ORDER BY open_time DESC
+        SELECT * FROM withdraw.withdraw_link WHERE {clause}
+        ORDER BY {sortby} {filters.direction}, id
         """
 
     if limit > 0:
         query_str += """ LIMIT :limit OFFSET :offset"""
-        query_params = {"limit": limit, "offset": offset}
+        query_params = {**values, "limit": limit, "offset": offset}
     else:
-        query_params = {}
+        query_params = values
 
-    links = await db.fetchall(
-        query_str,
-        query_params,
-        WithdrawLink,
-    )
-    result = await db.execute(
+    source = get_replica(*wallet_ids) or bulk_db
+    rows: list[dict] = await source.fetchall(query_str, query_params)
+    result = await source.execute(
         f"""
         SELECT COUNT(*) as total FROM withdraw.withdraw_link
-        WHERE wallet IN ({q})
-        """
+        WHERE {clause}
+        """,
+        values,
     )
     result2 = result.mappings().first()
 
-    return PaginatedWithdraws(data=links, total=int(result2.total))
-
-
-async def remove_unique_withdraw_link(link: WithdrawLink, unique_hash: str) -> None:
-    unique_links = [
-        x.strip()
-        for x in link.usescsv.split(",")
-        if unique_hash != shortuuid.uuid(name=link.id + link.unique_hash + x.strip())
-    ]
-    link.usescsv = ",".join(unique_links)
-    await update_withdraw_link(link)
-
-
-async def increment_withdraw_link(link: WithdrawLink) -> None:
-    link.used = link.used + 1
-    link.open_time = int(datetime.now().timestamp())
-    await update_withdraw_link(link)
+    return [WithdrawLinkRow.from_row(row) for row in rows], int(result2.total)
+
+
+async def iter_withdraw_links(
+    wallet_ids: list[str],
+    filters: WithdrawLinkFilters | None = None,
+    chunk_size: int = 500,
+) -> AsyncIterator[list[WithdrawLinkRow]]:
+    """
+    Yield all matching links in chunks, ordered by id. Every chunk is its own
+    short keyset query, so no connection is held between chunks.
+    """
+    if not wallet_ids:
+        return
+    clause, values = _withdraw_links_where(wallet_ids, filters or WithdrawLinkFilters())
+    source = get_replica(*wallet_ids) or bulk_db
+    after = ""
+    while True:
+        rows: list[dict] = await source.fetchall(
+            f"""
+            SELECT * FROM withdraw.withdraw_link WHERE {clause} AND id > :after
+            ORDER BY id LIMIT :chunk_size
+            """,
+            {**values, "after": after, "chunk_size": chunk_size},
+        )
+        if not rows:
+            return
+        yield [WithdrawLinkRow.from_row(row) for row in rows]
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1]["id"]
+
+
+async def remove_unique_withdraw_link(link: WithdrawLink, *unique_hashes: str) -> None:
+    # read and write `usescsv` on one connection, so concurrent redemptions of
+    # other vouchers of the same link are not overwritten
+    async with db.connect() as conn:
+        row = await conn.fetchone(
+            "SELECT usescsv FROM withdraw.withdraw_link WHERE id = :id",
+            {"id": link.id},
+        )
+        unique_links = [
+            x.strip()
+            for x in (row["usescsv"] if row else link.usescsv).split(",")
+            if shortuuid.uuid(name=link.id + link.unique_hash + x.strip())
+            not in unique_hashes
+        ]
+        link.usescsv = ",".join(unique_links)
+        await conn.execute(
+            "UPDATE withdraw.withdraw_link SET usescsv = :usescsv WHERE id = :id",
+            {"id": link.id, "usescsv": link.usescsv},
+        )
+
+
+async def claim_withdraw_link(link: WithdrawLink, now: int) -> bool:
+    """
+    Reserve one use of the link in a single conditional UPDATE. This is what
+    guarantees a link is never paid out more than `uses` times.
+    """
+    result = await db.execute(
+        """
+        UPDATE withdraw.withdraw_link SET used = used + 1, open_time = :now
+        WHERE id = :id AND used < uses AND open_time + wait_time <= :now
+        """,
+        {"id": link.id, "now": now},
+    )
+    if result.rowcount != 1:
+        return False
+    link.used += 1
+    link.open_time = now
+    return True
 
 
-async def update_withdraw_link(link: WithdrawLink) -> WithdrawLink:
-    await db.update("withdraw.withdraw_link", link)
+async def release_withdraw_link(
+    link: WithdrawLink, claimed_at: int, open_time: int
+) -> None:
+    """Give back a use reserved by `claim_withdraw_link`."""
+    await db.execute(
+        """
+        UPDATE withdraw.withdraw_link SET used = used - 1,
+        open_time = CASE WHEN open_time = :claimed_at
+            THEN :open_time ELSE open_time END
+        WHERE id = :id AND used > 0
+        """,
+        {"id": link.id, "claimed_at": claimed_at, "open_time": open_time},
+    )
+    link.used -= 1
+
+
+async def patch_withdraw_link(
+    link_id: str, values: dict, version: int | None = None
+) -> WithdrawLink | None:
+    """
+    Write only the given columns and bump the link's `version`, in one UPDATE.
+    With `version` nothing is written when the link was edited since that
+    version was read. Redemptions do not count as edits, they only write
+    `used`, `open_time` and `usescsv`.
+
+    A new `uses` resizes `usescsv` from the current row on the same
+    connection, so vouchers redeemed meanwhile are not brought back.
+    Returns None when the link does not exist or the version does not match.
+    """
+    values = {**values, "id": link_id}
+    where = "id = :id" if version is None else "id = :id AND version = :version"
+    if version is not None:
+        values["version"] = version
+    lock = "" if db.type == SQLITE else "FOR UPDATE"
+    async with db.connect() as conn:
+        if "uses" in values:
+            row: dict | None = await conn.fetchone(
+                f"""
+                SELECT uses, used, usescsv FROM withdraw.withdraw_link
+                WHERE {where} {lock}
+                """,
+                values,
+            )
+            if not row:
+                return None
+            values["usescsv"] = resize_usescsv(
+                row["usescsv"], row["uses"], row["used"], values["uses"]
+            )
+        columns = [key for key in values if key not in ("id", "version")]
+        link = await conn.fetchone(
+            f"""
+            UPDATE withdraw.withdraw_link
+            SET {", ".join(f"{key} = :{key}" for key in columns)},
+            version = version + 1
+            WHERE {where}
+            RETURNING *
+            """,
+            values,
+            WithdrawLink,
+        )
+        await conn.conn.commit()
+    if link:
+        _pin_wallet(link.wallet)
     return link
 
 
 async def delete_withdraw_link(link_id: str) -> None:
-    await db.execute(
+    if replica_enabled():
+        row: dict | None = await db.fetchone(
+            "SELECT wallet FROM withdraw.withdraw_link WHERE id = :id",
+            {"id": link_id},
+        )
+        if row:
+            _pin_wallet(row["wallet"])
+    result = await db.execute(
         "DELETE FROM withdraw.withdraw_link WHERE id = :id", {"id": link_id}
     )
+    forget_unique_hashes(result.rowcount)
+
+
+async def _execute_uncommitted(conn: Connection, query: str, values: dict):
+    """Execute on `conn` without the commit `Connection.execute` does."""
+    return await conn.conn.execute(text(conn.rewrite_query(query)), values)
+
+
+async def claim_withdraw_vouchers(
+    claims: list[tuple[WithdrawLink, list[str]]], now: int
+) -> bool:
+    """
+    Claim unique vouchers of one or more links in a single transaction, a hash
+    check per voucher and one use per voucher on its link. Nothing is claimed
+    if a voucher is already claimed or a link has not enough uses left.
+    """
+    async with db.connect() as conn:
+        try:
+            for link, hashes in claims:
+                for the_hash in hashes:
+                    await _execute_uncommitted(
+                        conn,
+                        """
+                        INSERT INTO withdraw.hash_check (id, lnurl_id)
+                        VALUES (:id, :lnurl_id)
+                        """,
+                        {"id": the_hash, "lnurl_id": link.k1},
+                    )
+                result = await _execute_uncommitted(
+                    conn,
+                    """
+                    UPDATE withdraw.withdraw_link
+                    SET used = used + :count, open_time = :now
+                    WHERE id = :id AND used + :count <= uses
+                    AND open_time + wait_time <= :now
+                    """,
+                    {"id": link.id, "count": len(hashes), "now": now},
+                )
+                if result.rowcount != 1:
+                    raise ValueError(f"Not enough uses left on {link.id}.")
+        except Exception:
+            await conn.conn.rollback()
+            return False
+        await conn.conn.commit()
+    return True
+
+
+async def release_withdraw_vouchers(
+    claims: list[tuple[WithdrawLink, list[str]]], claimed_at: int
+) -> None:
+    """Undo `claim_withdraw_vouchers`, in a single transaction."""
+    async with db.connect() as conn:
+        for link, hashes in claims:
+            for the_hash in hashes:
+                await _execute_uncommitted(
+                    conn,
+                    "DELETE FROM withdraw.hash_check WHERE id = :hash",
+                    {"hash": the_hash},
+                )
+            await _execute_uncommitted(
+                conn,
+                """
+                UPDATE withdraw.withdraw_link SET used = used - :count,
+                open_time = CASE WHEN open_time = :claimed_at
+                    THEN :open_time ELSE open_time END
+                WHERE id = :id AND used >= :count
+                """,
+                {
+                    "id": link.id,
+                    "count": len(hashes),
+                    "claimed_at": claimed_at,
+                    "open_time": link.open_time,
+                },
+            )
+        await conn.conn.commit()
 
 
 def chunks(lst, n):
@@ -169,7 +478,233 @@ async def get_hash_check(the_hash: str, lnurl_id: str) -> HashCheck:
             return HashCheck(lnurl=True, hash=True)
 
 
+async def get_claimed_vouchers(k1: str, hashes: list[str]) -> set[str]:
+    """
+    The hashes claimed by the link with `k1`, as primary key lookups on
+    `hash_check`. Reads from the bulk handle, kiosks poll this in large batches.
+    """
+    claimed: set[str] = set()
+    async with bulk_db.connect() as conn:
+        for batch in chunks(hashes, 500):
+            values = {f"hash_{i}": the_hash for i, the_hash in enumerate(batch)}
+            rows: list[dict] = await conn.fetchall(
+                f"""
+                SELECT id FROM withdraw.hash_check
+                WHERE id IN ({", ".join(f":{key}" for key in values)})
+                AND lnurl_id = :k1
+                """,
+                {**values, "k1": k1},
+            )
+            claimed.update(row["id"] for row in rows)
+    return claimed
+
+
 async def delete_hash_check(the_hash: str) -> None:
     await db.execute(
         "DELETE FROM withdraw.hash_check WHERE id = :hash", {"hash": the_hash}
     )
+
+
+def _set_withdraw_settings(data: WithdrawSettings) -> WithdrawSettings:
+    for key, value in data.dict().items():
+        setattr(withdraw_settings, key, value)
+    return withdraw_settings
+
+
+async def get_withdraw_settings() -> WithdrawSettings:
+    settings = await db.fetchone(
+        "SELECT * FROM withdraw.settings WHERE id = 'settings'",
+        model=WithdrawSettings,
+    )
+    if settings:
+        _set_withdraw_settings(settings)
+    return withdraw_settings
+
+
+async def update_withdraw_settings(data: WithdrawSettings) -> WithdrawSettings:
+    await db.update("withdraw.settings", data, "WHERE id = 'settings'")
+    return _set_withdraw_settings(data)
+
+
+async def _insert_many(table_name: str, models: Sequence[BaseModel]) -> None:
+    """
+    Insert models with a single multi-row INSERT. Like `db.insert` the values of
+    `model_to_dict` are passed as they are, they are already database ready.
+    """
+    if not models:
+        return
+    columns = list(model_to_dict(models[0]).keys())
+    rows = []
+    values = {}
+    for i, model in enumerate(models):
+        for key, value in model_to_dict(model).items():
+            values[f"{key}_{i}"] = value
+        rows.append("(" + ", ".join(f":{key}_{i}" for key in columns) + ")")
+    async with db.connect() as conn:
+        await _execute_uncommitted(
+            conn,
+            f"""
+            INSERT INTO {table_name} ({", ".join(f'"{key}"' for key in columns)})
+            VALUES {", ".join(rows)}
+            """,
+            values,
+        )
+        await conn.conn.commit()
+
+
+async def create_withdraw_attempts(attempts: list[WithdrawAttempt]) -> None:
+    """Insert a batch of journal entries with a single multi-row INSERT."""
+    await _insert_many("withdraw.attempt", attempts)
+
+
+async def get_withdraw_attempts(
+    wallet_id: str,
+    link_id: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    limit: int = 100,
+    offset: int = 0,
+) -> list[WithdrawAttempt]:
+    where = ["l.wallet = :wallet"]
+    values: dict = {"wallet": wallet_id, "limit": limit, "offset": offset}
+    if link_id:
+        where.append("a.link_id = :link_id")
+        values["link_id"] = link_id
+    if since:
+        where.append(f"a.created_at >= {db.timestamp_placeholder('since')}")
+        values["since"] = since
+    if until:
+        where.append(f"a.created_at < {db.timestamp_placeholder('until')}")
+        values["until"] = until
+    return await bulk_db.fetchall(
+        f"""
+        SELECT a.* FROM withdraw.attempt a
+        JOIN withdraw.withdraw_link l ON l.id = a.link_id
+        WHERE {" AND ".join(where)}
+        ORDER BY a.created_at DESC
+        LIMIT :limit OFFSET :offset
+        """,
+        values,
+        WithdrawAttempt,
+    )
+
+
+async def create_withdraw_pool(
+    data: CreateWithdrawPoolData, wallet_id: str
+) -> WithdrawPool:
+    pool = WithdrawPool(
+        id=urlsafe_short_hash()[:22],
+        wallet=wallet_id,
+        created_at=datetime.now(),
+        **data.dict(),
+    )
+    await db.insert("withdraw.pool", pool)
+    return pool
+
+
+# `available` counts the links of the pool that are not claimed yet
+_pools_query = """
+    SELECT * FROM (
+        SELECT p.*, (
+            SELECT COUNT(*) FROM withdraw.withdraw_link l WHERE l.pool_id = p.id
+        ) AS available
+        FROM withdraw.pool p
+    ) pools
+"""
+
+
+async def get_withdraw_pool(pool_id: str) -> WithdrawPool | None:
+    """The template only, `available` is left at 0."""
+    return await db.fetchone(
+        "SELECT * FROM withdraw.pool WHERE id = :id", {"id": pool_id}, WithdrawPool
+    )
+
+
+async def get_withdraw_pools(wallet_id: str) -> list[WithdrawPool]:
+    return await db.fetchall(
+        f"{_pools_query} WHERE wallet = :wallet ORDER BY created_at",
+        {"wallet": wallet_id},
+        WithdrawPool,
+    )
+
+
+async def get_withdraw_pools_to_refill() -> list[WithdrawPool]:
+    return await db.fetchall(
+        f"{_pools_query} WHERE available < size", model=WithdrawPool
+    )
+
+
+async def delete_withdraw_pool(pool_id: str) -> None:
+    """Delete the pool and its unclaimed links, claimed links are kept."""
+    async with db.connect() as conn:
+        result = await _execute_uncommitted(
+            conn,
+            "DELETE FROM withdraw.withdraw_link WHERE pool_id = :id",
+            {"id": pool_id},
+        )
+        await _execute_uncommitted(
+            conn, "DELETE FROM withdraw.pool WHERE id = :id", {"id": pool_id}
+        )
+        await conn.conn.commit()
+    forget_unique_hashes(result.rowcount)
+
+
+def _pool_link_data(pool: WithdrawPool, amount: int) -> CreateWithdrawData:
+    return CreateWithdrawData(
+        title=pool.title,
+        min_withdrawable=amount,
+        max_withdrawable=amount,
+        uses=pool.uses,
+        wait_time=pool.wait_time,
+        is_unique=pool.is_unique,
+        webhook_url=pool.webhook_url,
+        webhook_headers=pool.webhook_headers,
+        webhook_body=pool.webhook_body,
+        webhook_digest=pool.webhook_digest,
+        custom_url=pool.custom_url,
+    )
+
+
+async def create_pooled_withdraw_links(pool: WithdrawPool, count: int) -> None:
+    """Pre-create disabled links of the pool, the amount is set when claimed."""
+    data = _pool_link_data(pool, pool.max_amount)
+    links = []
+    for _ in range(count):
+        link = _new_withdraw_link(data, pool.wallet)
+        link.enabled = False
+        link.pool_id = pool.id
+        links.append(link)
+    await _insert_many("withdraw.withdraw_link", links)
+
+
+async def claim_pooled_withdraw_link(pool: WithdrawPool, amount: int) -> WithdrawLink:
+    """
+    Take one link out of the pool and enable it for `amount` in a single UPDATE.
+    When the pool is empty the link is created from the template instead.
+    """
+    # concurrent claims on postgres skip the row another claim is updating
+    skip_locked = "" if db.type == SQLITE else "FOR UPDATE SKIP LOCKED"
+    async with db.connect() as conn:
+        link = await conn.fetchone(
+            f"""
+            UPDATE withdraw.withdraw_link SET enabled = true, pool_id = NULL,
+            min_withdrawable = :amount, max_withdrawable = :amount,
+            open_time = :now + wait_time, created_at = {db.timestamp_now}
+            WHERE pool_id = :pool_id AND id = (
+                SELECT id FROM withdraw.withdraw_link WHERE pool_id = :pool_id
+                LIMIT 1 {skip_locked}
+            )
+            RETURNING *
+            """,
+            {
+                "pool_id": pool.id,
+                "amount": amount,
+                "now": int(datetime.now().timestamp()),
+            },
+            WithdrawLink,
+        )
+        await conn.conn.commit()
+    if not link:
+        return await create_withdraw_link(_pool_link_data(pool, amount), pool.wallet)
+    _pin_wallet(link.wallet)
+    return link
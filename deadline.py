@@ -0,0 +1,77 @@
+import asyncio
+import time
+from collections.abc import Callable, Coroutine
+from typing import Any, TypeVar
+
+T = TypeVar("T")
+
+# counters since startup, exposed to admins through `/api/v1/metrics`
+deadline_stats = {"misses": 0, "detached_payments": 0}
+
+# keep a reference to callbacks that outlived their deadline until they finish
+_detached: set[asyncio.Task] = set()
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class CallbackDeadline:
+    """
+    Time budget of a single LNURL callback. Stages call `check()` before they
+    start, so an expired callback stops at the next stage boundary and can
+    release its claim itself. Once the payment started (`committed`) the
+    callback always runs to the end, so the claim and counters are reconciled.
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds if seconds > 0 else None
+        self.committed = False
+
+    @property
+    def remaining(self) -> float | None:
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.monotonic(), 0)
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining == 0
+
+    def check(self) -> None:
+        if not self.committed and self.expired:
+            raise DeadlineExceededError
+
+
+async def run_with_deadline(
+    coro: Coroutine[Any, Any, T],
+    deadline: CallbackDeadline,
+    on_detached_done: Callable[["asyncio.Task[T]"], None] | None = None,
+) -> T:
+    """
+    Await `coro` for at most the remaining budget. On timeout the task is not
+    cancelled but detached, it stops at its next `check()` or, if the payment
+    already started, finishes in the background. `on_detached_done` is called
+    with the task once a detached callback finished, to record its outcome.
+    """
+    if deadline.expires_at is None:
+        return await coro
+    task = asyncio.ensure_future(coro)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), deadline.remaining)
+    except asyncio.TimeoutError as exc:
+        if deadline.committed:
+            deadline_stats["detached_payments"] += 1
+        _detached.add(task)
+        task.add_done_callback(_forget)
+        if on_detached_done:
+            task.add_done_callback(on_detached_done)
+        raise DeadlineExceededError from exc
+
+
+def _forget(task: asyncio.Task) -> None:
+    _detached.discard(task)
+    # retrieve the result so a late `DeadlineExceededError` is not logged as lost
+    if not task.cancelled():
+        task.exception()
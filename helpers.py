@@ -1,12 +1,26 @@
+from typing import Any
+
+import orjson
 from fastapi import Request
+from fastapi.responses import JSONResponse
 from lnurl import Lnurl
 from lnurl import encode as lnurl_encode
 from shortuuid import uuid
 
-from .models import WithdrawLink
+from .models import WithdrawLink, WithdrawLinkRow
+
+
+def json_dumps(content: Any) -> bytes:
+    """Serialize to compact JSON, dataclasses and datetimes included."""
+    return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
 
+class WithdrawJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return json_dumps(content)
 
-def create_lnurl(link: WithdrawLink, req: Request) -> Lnurl:
+
+def create_lnurl(link: WithdrawLink | WithdrawLinkRow, req: Request) -> Lnurl:
     if link.is_unique:
         usescssv = link.usescsv.split(",")
         tohash = link.id + link.unique_hash + usescssv[link.number]
@@ -26,3 +40,58 @@ def create_lnurl(link: WithdrawLink, req: Request) -> Lnurl:
             f"Error creating LNURL with url: `{url!s}`, "
             "check your webserver proxy configuration."
         ) from e
+
+
+def voucher_lnurls(link: WithdrawLink, req: Request) -> list[Lnurl]:
+    """The LNURL of every voucher of the link, CPU bound for large links."""
+    lnurls = []
+    # the link is fetched once, only `number` changes between the vouchers
+    for number in range(len(link.usescsv.split(","))):
+        link.number = number
+        lnurls.append(create_lnurl(link, req))
+    return lnurls
+
+
+def voucher_hashes(link: WithdrawLink) -> list[str]:
+    """The `id_unique_hash` of every voucher of the link that is not redeemed."""
+    return [
+        uuid(name=link.id + link.unique_hash + number.strip())
+        for number in link.usescsv.split(",")
+    ]
+
+
+def issued_voucher_hashes(link: WithdrawLink) -> set[str]:
+    """
+    The `id_unique_hash` of every voucher the link issued, redeemed or not.
+    Voucher numbers are contiguous and only grow, so these are the numbers up
+    to the highest one still in `usescsv` or the last of the first `uses`.
+    """
+    numbers = [int(number) for number in link.usescsv.split(",") if number.strip()]
+    highest = max([link.uses - 1, *numbers])
+    return {
+        uuid(name=link.id + link.unique_hash + str(number))
+        for number in range(highest + 1)
+    }
+
+
+def resize_usescsv(usescsv: str, current_uses: int, used: int, uses: int) -> str:
+    """
+    The `usescsv` of a link whose `uses` change from `current_uses` to `uses`.
+    Raises ValueError when it would drop uses that were already redeemed.
+    """
+    numbers = usescsv.split(",")
+    if current_uses > uses:
+        if uses - used <= 0:
+            raise ValueError("Cannot reduce uses below current used.")
+        return ",".join(numbers[: uses - used])
+    if current_uses < uses:
+        if numbers[-1] == "":
+            current_number = int(current_uses)
+            numbers[-1] = str(current_uses)
+        else:
+            current_number = int(numbers[-1])
+        while len(numbers) < (uses - used):
+            current_number += 1
+            numbers.append(str(current_number))
+        return ",".join(numbers)
+    return usescsv
@@ -0,0 +1,69 @@
+import asyncio
+from collections.abc import AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+from typing import Any, TypeVar
+
+from fastapi import HTTPException
+
+T = TypeVar("T")
+
+# heavy admin and export requests that may run at once, others wait for a slot
+HEAVY_CONCURRENCY = 2
+# seconds a heavy request waits for a slot before it is turned away
+HEAVY_WAIT = 30
+# listings above this many rows count as heavy
+HEAVY_LISTING = 100
+
+# counters since startup, exposed to admins through `/api/v1/metrics`
+isolation_stats = {"heavy_running": 0, "heavy_rejected": 0}
+
+_heavy_slots = asyncio.Semaphore(HEAVY_CONCURRENCY)
+
+# bech32 encoding, serialization and compression of bulk responses run on these
+# threads. They still share the GIL, but the event loop gets it back every few
+# milliseconds instead of waiting for a whole export to be encoded.
+_encoder = ThreadPoolExecutor(max_workers=2, thread_name_prefix="withdraw-encoder")
+
+
+async def run_in_encoder(func: Callable[..., T], *args: Any) -> T:
+    return await asyncio.get_running_loop().run_in_executor(_encoder, func, *args)
+
+
+async def acquire_heavy_slot() -> Callable[[], None]:
+    """
+    Wait for a heavy slot. Returns the function that gives it back, it may be
+    called more than once, so streamed responses can release from two places.
+    """
+    try:
+        await asyncio.wait_for(_heavy_slots.acquire(), HEAVY_WAIT)
+    except asyncio.TimeoutError as exc:
+        isolation_stats["heavy_rejected"] += 1
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail="Too many exports are running, try again later.",
+        ) from exc
+    isolation_stats["heavy_running"] += 1
+    released = False
+
+    def release() -> None:
+        nonlocal released
+        if not released:
+            released = True
+            isolation_stats["heavy_running"] -= 1
+            _heavy_slots.release()
+
+    return release
+
+
+@asynccontextmanager
+async def heavy_slot(heavy: bool = True) -> AsyncIterator[None]:
+    if not heavy:
+        yield
+        return
+    release = await acquire_heavy_slot()
+    try:
+        yield
+    finally:
+        release()
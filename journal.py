@@ -0,0 +1,58 @@
+import asyncio
+from contextlib import suppress
+
+from loguru import logger
+
+from .crud import create_withdraw_attempts
+from .models import WithdrawAttempt
+
+# flush when this many attempts are buffered, or every FLUSH_INTERVAL seconds
+FLUSH_SIZE = 100
+FLUSH_INTERVAL = 2
+# upper bound for the buffer while the database is unavailable
+MAX_BUFFER = 10_000
+
+_buffer: list[WithdrawAttempt] = []
+_flush_event = asyncio.Event()
+
+
+def record_withdraw_attempt(attempt: WithdrawAttempt) -> None:
+    """
+    Queue an attempt for the journal. Never touches the database, the entries
+    are written in batches by `run_attempt_journal`.
+    """
+    _buffer.append(attempt)
+    if len(_buffer) > MAX_BUFFER:
+        del _buffer[: len(_buffer) - MAX_BUFFER]
+        logger.warning("withdraw attempt journal is full, dropping oldest entries.")
+    if len(_buffer) >= FLUSH_SIZE:
+        _flush_event.set()
+
+
+async def flush_withdraw_attempts() -> int:
+    if not _buffer:
+        return 0
+    batch = _buffer[:FLUSH_SIZE]
+    del _buffer[: len(batch)]
+    try:
+        await create_withdraw_attempts(batch)
+    except Exception:
+        # put the batch back in front, it is retried on the next flush
+        _buffer[:0] = batch
+        raise
+    return len(batch)
+
+
+async def run_attempt_journal() -> None:
+    try:
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(_flush_event.wait(), FLUSH_INTERVAL)
+            _flush_event.clear()
+            while await flush_withdraw_attempts() == FLUSH_SIZE:
+                pass
+    except asyncio.CancelledError:
+        with suppress(Exception):
+            while await flush_withdraw_attempts():
+                pass
+        raise
@@ -0,0 +1,174 @@
+import asyncio
+import hashlib
+import math
+import time
+from collections.abc import Iterator
+
+from lnbits.db import Database
+from loguru import logger
+
+from .models import WithdrawSettings
+
+# the filter is sized for twice the links it is built with, at least this many
+MIN_CAPACITY = 100_000
+# unique hashes read per query while building, the loop runs between batches
+BUILD_BATCH = 1_000
+# seconds between two checks whether the filter has to be rebuilt
+CHECK_INTERVAL = 60
+# seconds after which the filter is rebuilt anyway, this drops deleted links and
+# picks up links written by anything other than this process
+REBUILD_INTERVAL = 3600
+
+# state of the filter, exposed to admins through `/api/v1/metrics`
+lookup_filter_stats: dict = {
+    "ready": False,
+    "capacity": 0,
+    "count": 0,
+    "stale": 0,
+    "error_rate": 0.0,
+    "hashes": 0,
+    "bytes": 0,
+    "rejected": 0,
+    "passed": 0,
+    "false_positives": 0,
+}
+
+
+class BloomFilter:
+    """
+    Set of strings that answers "definitely not in it" or "maybe in it", in
+    about `1.44 * log2(1 / error_rate)` bits per member.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str) -> Iterator[int]:
+        # double hashing, two 64 bit halves of one digest give all positions
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (first + i * step) % self.size
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+# filter that lookups use, None until the first build finished or when disabled
+_filter: BloomFilter | None = None
+# hashes of links created while a filter is built, merged into it at the swap
+_pending: set[str] | None = None
+_built_at = 0.0
+
+
+def might_exist(unique_hash: str) -> bool:
+    """False only for hashes that are definitely not a link."""
+    if _filter is None:
+        return True
+    if unique_hash in _filter:
+        lookup_filter_stats["passed"] += 1
+        return True
+    lookup_filter_stats["rejected"] += 1
+    return False
+
+
+def add_unique_hash(unique_hash: str) -> None:
+    if _filter is not None:
+        _filter.add(unique_hash)
+    if _pending is not None:
+        _pending.add(unique_hash)
+    lookup_filter_stats["count"] = _filter.count if _filter else 0
+
+
+def forget_unique_hashes(count: int) -> None:
+    """
+    Record deleted links. Members can not be removed from a Bloom filter, their
+    hashes pass until the next rebuild.
+    """
+    lookup_filter_stats["stale"] += count
+
+
+def note_false_positive() -> None:
+    lookup_filter_stats["false_positives"] += 1
+
+
+async def build_lookup_filter(db: Database, error_rate: float) -> None:
+    """Build a filter of all unique hashes and swap it in, 0 disables it."""
+    global _filter, _pending, _built_at
+    if not error_rate:
+        _filter = None
+        lookup_filter_stats.update(ready=False, capacity=0, count=0, bytes=0)
+        return
+    # recorded before the first await, a link created at any point of the build
+    # is either read by the scan or merged at the swap
+    _pending = set()
+    try:
+        row: dict = await db.fetchone(
+            "SELECT COUNT(*) AS total FROM withdraw.withdraw_link"
+        )
+        building = BloomFilter(max(MIN_CAPACITY, 2 * row["total"]), error_rate)
+        after = ""
+        while True:
+            rows: list[dict] = await db.fetchall(
+                """
+                SELECT unique_hash FROM withdraw.withdraw_link
+                WHERE unique_hash > :after ORDER BY unique_hash LIMIT :limit
+                """,
+                {"after": after, "limit": BUILD_BATCH},
+            )
+            for row in rows:
+                building.add(row["unique_hash"])
+            if len(rows) < BUILD_BATCH:
+                break
+            after = rows[-1]["unique_hash"]
+        for unique_hash in _pending:
+            if unique_hash not in building:
+                building.add(unique_hash)
+        _filter, _built_at = building, time.monotonic()
+    finally:
+        _pending = None
+    lookup_filter_stats.update(
+        ready=True,
+        capacity=_filter.capacity,
+        count=_filter.count,
+        stale=0,
+        error_rate=_filter.error_rate,
+        hashes=_filter.hashes,
+        bytes=len(_filter.bits),
+    )
+    logger.debug(
+        f"withdraw: lookup filter of {_filter.count} hashes, "
+        f"{len(_filter.bits)} bytes."
+    )
+
+
+def _needs_rebuild(error_rate: float) -> bool:
+    if _filter is None:
+        return bool(error_rate)
+    return (
+        _filter.error_rate != error_rate
+        or _filter.count > _filter.capacity
+        or lookup_filter_stats["stale"] > _filter.count // 10
+        or time.monotonic() - _built_at > REBUILD_INTERVAL
+    )
+
+
+async def run_lookup_filter(db: Database, settings: WithdrawSettings) -> None:
+    while True:
+        if _needs_rebuild(settings.lookup_filter_error_rate):
+            await build_lookup_filter(db, settings.lookup_filter_error_rate)
+        await asyncio.sleep(CHECK_INTERVAL)
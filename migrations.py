@@ -1,3 +1,6 @@
+from .backfill import backfill
+
+
 async def m001_initial(db):
     """
     Creates an improved withdraw table and migrates the existing data.
@@ -29,7 +32,7 @@ async def m002_change_withdraw_table(db):
     """
     await db.execute(
         f"""
-        CREATE TABLE withdraw.withdraw_link (
+        CREATE TABLE IF NOT EXISTS withdraw.withdraw_link (
             id TEXT PRIMARY KEY,
             wallet TEXT,
             title TEXT,
@@ -47,52 +50,27 @@ async def m002_change_withdraw_table(db):
         """
     )
 
-    for row in [
-        list(row) for row in await db.fetchall("SELECT * FROM withdraw.withdraw_links")
-    ]:
-        usescsv = ""
-
-        for i in range(row[5]):
-            if row[7]:
-                usescsv += "," + str(i + 1)
+    async def copy_links(conn, rows):
+        values = {}
+        placeholders = []
+        for i, row in enumerate(rows):
+            if row["is_unique"]:
+                usescsv = ",".join(str(n + 1) for n in range(row["uses"]))
             else:
-                usescsv += "," + str(1)
-        usescsv = usescsv[1:]
-        await db.execute(
-            """
-            INSERT INTO withdraw.withdraw_link (
-                id,
-                wallet,
-                title,
-                min_withdrawable,
-                max_withdrawable,
-                uses,
-                wait_time,
-                is_unique,
-                unique_hash,
-                k1,
-                open_time,
-                used,
-                usescsv
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                usescsv = ",".join("1" for _ in range(row["uses"]))
+            columns = {**row, "usescsv": usescsv}
+            values.update({f"{key}_{i}": value for key, value in columns.items()})
+            placeholders.append("(" + ", ".join(f":{key}_{i}" for key in columns) + ")")
+        await conn.execute(
+            f"""
+            INSERT INTO withdraw.withdraw_link ({", ".join(rows[0].keys())})
+            VALUES {", ".join(placeholders)}
+            ON CONFLICT (id) DO NOTHING
             """,
-            (
-                row[0],
-                row[1],
-                row[2],
-                row[3],
-                row[4],
-                row[5],
-                row[6],
-                row[7],
-                row[8],
-                row[9],
-                row[10],
-                row[11],
-                usescsv,
-            ),
+            values,
         )
+
+    await backfill(db, "m002_withdraw_link", "withdraw.withdraw_links", copy_links)
     await db.execute("DROP TABLE withdraw.withdraw_links")
 
 
@@ -145,3 +123,151 @@ async def m008_add_enabled_column(db):
     await db.execute(
         "ALTER TABLE withdraw.withdraw_link ADD COLUMN enabled BOOLEAN DEFAULT true;"
     )
+
+
+async def m009_add_settings_table(db):
+    """
+    Adds a single row table for admin controlled extension settings.
+    """
+    await db.execute(
+        """
+        CREATE TABLE withdraw.settings (
+            id TEXT PRIMARY KEY,
+            profiler_enabled BOOLEAN DEFAULT false,
+            profiler_sample_rate REAL DEFAULT 0.01,
+            profiler_max_files INTEGER DEFAULT 100
+        );
+        """
+    )
+    await db.execute("INSERT INTO withdraw.settings (id) VALUES ('settings')")
+
+
+async def m010_add_attempt_journal(db):
+    """
+    Adds an append-only journal of LNURL callback attempts.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE withdraw.attempt (
+            id TEXT PRIMARY KEY,
+            link_id TEXT NOT NULL,
+            voucher_hash TEXT,
+            amount_msat {db.big_int},
+            outcome TEXT NOT NULL,
+            reason TEXT,
+            timings TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_column_default}
+        );
+        """
+    )
+    if db.type == "SQLITE":
+        index = "CREATE INDEX withdraw.attempt_link_created ON attempt"
+    else:
+        index = "CREATE INDEX attempt_link_created ON withdraw.attempt"
+    await db.execute(f"{index} (link_id, created_at)")
+
+
+async def m011_add_withdraw_link_indexes(db):
+    """
+    Adds indexes for the wallet scoped listing, filters and sort orders.
+    """
+    for name, columns in (
+        ("withdraw_link_wallet_open_time", "wallet, open_time"),
+        ("withdraw_link_wallet_created_at", "wallet, created_at"),
+        ("withdraw_link_wallet_max_withdrawable", "wallet, max_withdrawable"),
+    ):
+        if db.type == "SQLITE":
+            await db.execute(
+                f"CREATE INDEX withdraw.{name} ON withdraw_link ({columns})"
+            )
+        else:
+            await db.execute(
+                f"CREATE INDEX {name} ON withdraw.withdraw_link ({columns})"
+            )
+
+
+async def m012_add_callback_deadline(db):
+    """
+    Adds the callback deadline setting.
+    """
+    await db.execute(
+        "ALTER TABLE withdraw.settings ADD COLUMN callback_deadline INTEGER DEFAULT 25;"
+    )
+
+
+async def m013_add_replica_max_lag(db):
+    """
+    Adds the read replica lag setting.
+    """
+    await db.execute(
+        "ALTER TABLE withdraw.settings ADD COLUMN replica_max_lag INTEGER DEFAULT 5;"
+    )
+
+
+async def m014_add_link_pool(db):
+    """
+    Adds pools of pre-created, disabled links that are claimed on demand.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE withdraw.pool (
+            id TEXT PRIMARY KEY,
+            wallet TEXT NOT NULL,
+            title TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            max_amount {db.big_int} NOT NULL,
+            uses INTEGER NOT NULL DEFAULT 1,
+            wait_time INTEGER NOT NULL DEFAULT 1,
+            is_unique BOOLEAN NOT NULL DEFAULT false,
+            webhook_url TEXT,
+            webhook_headers TEXT,
+            webhook_body TEXT,
+            custom_url TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_column_default}
+        );
+        """
+    )
+    await db.execute("ALTER TABLE withdraw.withdraw_link ADD COLUMN pool_id TEXT;")
+    if db.type == "SQLITE":
+        index = "CREATE INDEX withdraw.withdraw_link_pool ON withdraw_link"
+    else:
+        index = "CREATE INDEX withdraw_link_pool ON withdraw.withdraw_link"
+    await db.execute(f"{index} (pool_id)")
+
+
+async def m015_add_webhook_digest(db):
+    """
+    Adds the webhook digest option to links and pools, and its thresholds.
+    """
+    for table in ("withdraw_link", "pool"):
+        await db.execute(
+            f"ALTER TABLE withdraw.{table} "
+            "ADD COLUMN webhook_digest BOOLEAN DEFAULT false;"
+        )
+    await db.execute(
+        "ALTER TABLE withdraw.settings "
+        "ADD COLUMN webhook_digest_size INTEGER DEFAULT 100;"
+    )
+    await db.execute(
+        "ALTER TABLE withdraw.settings "
+        "ADD COLUMN webhook_digest_interval INTEGER DEFAULT 10;"
+    )
+
+
+async def m016_add_link_version(db):
+    """
+    Adds the edit counter used by PATCH to detect concurrent edits.
+    """
+    await db.execute(
+        "ALTER TABLE withdraw.withdraw_link ADD COLUMN version INTEGER DEFAULT 0;"
+    )
+
+
+async def m017_add_lookup_filter_error_rate(db):
+    """
+    Adds the false positive rate of the unknown hash filter.
+    """
+    await db.execute(
+        "ALTER TABLE withdraw.settings "
+        "ADD COLUMN lookup_filter_error_rate REAL DEFAULT 0.001;"
+    )
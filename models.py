@@ -1,6 +1,13 @@
-from datetime import datetime
+import time
+from collections.abc import Iterator, Mapping
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import cache
+from typing import Any, Literal
 
 from fastapi import Query
+from lnbits.db import dict_to_model
 from pydantic import BaseModel, Field
 
 
@@ -14,10 +21,39 @@ class CreateWithdrawData(BaseModel):
     webhook_url: str = Query(None)
     webhook_headers: str = Query(None)
     webhook_body: str = Query(None)
+    webhook_digest: bool = Query(
+        False, description="Coalesce webhook events into periodic digests"
+    )
     custom_url: str = Query(None)
     enabled: bool = Query(True)
 
 
+class UpdateWithdrawData(BaseModel):
+    """
+    Partial update of a link, only the fields that are sent are written.
+    """
+
+    title: str | None = Query(None)
+    min_withdrawable: int | None = Query(None, ge=1)
+    max_withdrawable: int | None = Query(None, ge=1)
+    uses: int | None = Query(None, ge=1)
+    wait_time: int | None = Query(None, ge=1)
+    is_unique: bool | None = Query(None)
+    webhook_url: str | None = Query(None)
+    webhook_headers: str | None = Query(None)
+    webhook_body: str | None = Query(None)
+    webhook_digest: bool | None = Query(None)
+    custom_url: str | None = Query(None)
+    enabled: bool | None = Query(None)
+    version: int | None = Query(
+        None,
+        description=(
+            "The `version` of the link the edit is based on. When the link was "
+            "edited since, nothing is written and 409 is returned."
+        ),
+    )
+
+
 class WithdrawLink(BaseModel):
     id: str
     wallet: str = Query(None)
@@ -39,6 +75,9 @@ class WithdrawLink(BaseModel):
     custom_url: str = Query(None)
     created_at: datetime
     enabled: bool = Query(True)
+    pool_id: str | None = Query(None)
+    webhook_digest: bool = Query(False)
+    version: int = Query(0)
     lnurl: str | None = Field(
         default=None,
         no_database=True,
@@ -60,11 +99,229 @@ class WithdrawLink(BaseModel):
         return self.used >= self.uses
 
 
+class _CreatedAt(BaseModel):
+    created_at: datetime
+
+
+@cache
+def _model_stamps_utc() -> bool:
+    """
+    Whether `dict_to_model` marks the naive timestamps postgres returns as UTC.
+    Older lnbits versions leave them naive, rows have to do the same.
+    """
+    probe = dict_to_model({"created_at": datetime(2000, 1, 1)}, _CreatedAt)
+    return probe.created_at.tzinfo is not None
+
+
+@dataclass(slots=True)
+class WithdrawLinkRow:
+    """
+    Lightweight, read-only view of a `withdraw_link` row.
+    Used on list and export paths where building a `WithdrawLink` per row
+    dominates the request time. Field order matches `WithdrawLink`, so the
+    serialized output is the same.
+    """
+
+    id: str
+    wallet: str | None = None
+    title: str | None = None
+    min_withdrawable: int = 0
+    max_withdrawable: int = 0
+    uses: int = 0
+    wait_time: int = 0
+    is_unique: bool = False
+    unique_hash: str = ""
+    k1: str | None = None
+    open_time: int = 0
+    used: int = 0
+    usescsv: str = ""
+    number: int = 0
+    webhook_url: str | None = None
+    webhook_headers: str | None = None
+    webhook_body: str | None = None
+    custom_url: str | None = None
+    created_at: datetime | None = None
+    enabled: bool = True
+    pool_id: str | None = None
+    webhook_digest: bool = False
+    version: int = 0
+    lnurl: str | None = None
+    lnurl_url: str | None = None
+
+    @classmethod
+    def from_row(cls, row: Mapping[str, Any]) -> "WithdrawLinkRow":
+        created_at = row.get("created_at")
+        if isinstance(created_at, datetime):
+            if created_at.tzinfo is None and _model_stamps_utc():
+                created_at = created_at.replace(tzinfo=timezone.utc)
+        elif created_at is not None:
+            created_at = datetime.fromtimestamp(created_at, timezone.utc)
+        return cls(
+            id=row["id"],
+            wallet=row["wallet"],
+            title=row["title"],
+            min_withdrawable=row["min_withdrawable"] or 0,
+            max_withdrawable=row["max_withdrawable"] or 0,
+            uses=row["uses"] or 0,
+            wait_time=row["wait_time"] or 0,
+            is_unique=bool(row["is_unique"]),
+            unique_hash=row["unique_hash"],
+            k1=row["k1"],
+            open_time=row["open_time"] or 0,
+            used=row["used"] or 0,
+            usescsv=row["usescsv"],
+            webhook_url=row["webhook_url"],
+            webhook_headers=row["webhook_headers"],
+            webhook_body=row["webhook_body"],
+            custom_url=row["custom_url"],
+            created_at=created_at,
+            enabled=bool(row["enabled"]) if row["enabled"] is not None else True,
+            pool_id=row.get("pool_id"),
+            webhook_digest=bool(row.get("webhook_digest")),
+            version=row.get("version") or 0,
+        )
+
+    @property
+    def is_spent(self) -> bool:
+        return self.used >= self.uses
+
+
 class HashCheck(BaseModel):
     hash: bool
     lnurl: bool
 
 
+class VoucherStatusQuery(BaseModel):
+    hashes: list[str] = Field(
+        ..., min_items=1, max_items=5000, description="`id_unique_hash` values"
+    )
+
+
+class VoucherStatus(BaseModel):
+    uses: int
+    used: int
+    states: str = Field(
+        description=(
+            "One character per requested hash, in request order: `a` available, "
+            "`p` being paid out, `r` redeemed, `u` not a voucher of this link"
+        )
+    )
+
+
+class CreateWithdrawPoolData(BaseModel):
+    title: str = Query(...)
+    size: int = Query(10, ge=1, le=1000, description="Links kept ready to claim")
+    max_amount: int = Query(..., ge=1, description="Max sats a claim may ask for")
+    uses: int = Query(1, ge=1, le=250)
+    wait_time: int = Query(1, ge=1)
+    is_unique: bool = Query(False)
+    webhook_url: str = Query(None)
+    webhook_headers: str = Query(None)
+    webhook_body: str = Query(None)
+    webhook_digest: bool = Query(False)
+    custom_url: str = Query(None)
+
+
+class WithdrawPool(BaseModel):
+    """Template of the links that are pre-created for a wallet, see `pool.py`."""
+
+    id: str
+    wallet: str
+    title: str
+    size: int
+    max_amount: int
+    uses: int
+    wait_time: int
+    is_unique: bool
+    webhook_url: str = Query(None)
+    webhook_headers: str = Query(None)
+    webhook_body: str = Query(None)
+    webhook_digest: bool = Query(False)
+    custom_url: str = Query(None)
+    created_at: datetime
+    available: int = Field(default=0, no_database=True)
+
+
+class ClaimWithdrawPoolData(BaseModel):
+    amount: int = Query(..., ge=1, description="Amount of the link in sats")
+
+
+class SweepVoucher(BaseModel):
+    unique_hash: str
+    id_unique_hash: str
+
+
+class SweepWithdrawData(BaseModel):
+    pr: str = Query(..., description="One bolt11 invoice for all vouchers")
+    vouchers: list[SweepVoucher] = Query(..., min_items=1, max_items=100)
+
+
+class WithdrawAttempt(BaseModel):
+    id: str
+    link_id: str
+    voucher_hash: str | None = None
+    amount_msat: int | None = None
+    outcome: str = "error"
+    reason: str | None = None
+    timings: dict = Field(default_factory=dict)
+    created_at: datetime
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Record the duration of a callback stage in milliseconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round((time.perf_counter() - start) * 1000, 3)
+
+
+class WithdrawSettings(BaseModel):
+    profiler_enabled: bool = Query(False)
+    profiler_sample_rate: float = Query(0.01, ge=0, le=1)
+    profiler_max_files: int = Query(100, ge=1)
+    callback_deadline: int = Query(
+        25, ge=0, description="Seconds a withdraw callback may take, 0 disables"
+    )
+    replica_max_lag: int = Query(
+        5, ge=0, description="Seconds the read replica may lag behind the primary"
+    )
+    webhook_digest_size: int = Query(
+        100, ge=1, le=1000, description="Max events per webhook digest"
+    )
+    webhook_digest_interval: int = Query(
+        10, ge=1, description="Seconds a webhook event may wait for its digest"
+    )
+    lookup_filter_error_rate: float = Query(
+        0.001,
+        ge=0,
+        lt=1,
+        description="False positive rate of the unknown hash filter, 0 disables it",
+    )
+
+
+class WithdrawLinkFilters(BaseModel):
+    title: str | None = Query(None, description="Case insensitive title substring")
+    enabled: bool | None = Query(None)
+    spent: bool | None = Query(None)
+    is_unique: bool | None = Query(None)
+    amount_min: int | None = Query(None, ge=0, description="Min `max_withdrawable`")
+    amount_max: int | None = Query(None, ge=0, description="Max `max_withdrawable`")
+    created_from: datetime | None = Query(None)
+    created_to: datetime | None = Query(None)
+    sortby: Literal[
+        "title",
+        "created_at",
+        "open_time",
+        "wait_time",
+        "uses",
+        "uses_left",
+        "min_withdrawable",
+        "max_withdrawable",
+    ] = Query("open_time")
+    direction: Literal["asc", "desc"] = Query("desc")
+
+
 class PaginatedWithdraws(BaseModel):
     data: list[WithdrawLink]
     total: int
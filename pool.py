@@ -0,0 +1,39 @@
+import asyncio
+from contextlib import suppress
+
+from loguru import logger
+
+from .crud import create_pooled_withdraw_links, get_withdraw_pools_to_refill
+
+# refill after a claim, and every REFILL_INTERVAL seconds in case one was missed
+REFILL_INTERVAL = 60
+# links created per INSERT, large pools are filled in several batches
+REFILL_BATCH = 100
+
+_refill_event = asyncio.Event()
+
+
+def request_pool_refill() -> None:
+    _refill_event.set()
+
+
+async def refill_withdraw_pools() -> int:
+    created = 0
+    for pool in await get_withdraw_pools_to_refill():
+        missing = pool.size - pool.available
+        while missing > 0:
+            count = min(missing, REFILL_BATCH)
+            await create_pooled_withdraw_links(pool, count)
+            missing -= count
+            created += count
+    return created
+
+
+async def run_pool_refill() -> None:
+    while True:
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(_refill_event.wait(), REFILL_INTERVAL)
+        _refill_event.clear()
+        created = await refill_withdraw_pools()
+        if created:
+            logger.debug(f"withdraw: refilled pools with {created} links.")
@@ -0,0 +1,102 @@
+import asyncio
+import cProfile
+import random
+import time
+from collections.abc import Callable, Coroutine
+from pathlib import Path
+from typing import Any
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+from lnbits.settings import settings
+from loguru import logger
+
+from .crud import withdraw_settings
+
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+
+    HAS_PYINSTRUMENT = True
+except ImportError:  # pragma: no cover
+    HAS_PYINSTRUMENT = False
+
+# only one request is profiled at a time, concurrent requests run untouched
+_profiling = False
+
+
+def profiles_dir() -> Path:
+    return Path(settings.lnbits_data_folder, "withdraw", "profiles")
+
+
+class ProfiledRoute(APIRoute):
+    """
+    Route class that profiles a sample of requests when the admin enabled it in
+    the extension settings. When disabled it only costs a single attribute check.
+    Profiles are written as speedscope JSON (pyinstrument) or as cProfile stats
+    when pyinstrument is not installed.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+        name = self.name
+
+        async def profiled_handler(request: Request) -> Response:
+            if not withdraw_settings.profiler_enabled:
+                return await handler(request)
+            return await _profile_request(handler, request, name)
+
+        return profiled_handler
+
+
+async def _profile_request(
+    handler: Callable[[Request], Coroutine[Any, Any, Response]],
+    request: Request,
+    name: str,
+) -> Response:
+    global _profiling
+    if _profiling or random.random() >= withdraw_settings.profiler_sample_rate:
+        return await handler(request)
+
+    _profiling = True
+    started = time.time()
+    profiler: Any
+    if HAS_PYINSTRUMENT:
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return await handler(request)
+    finally:
+        if HAS_PYINSTRUMENT:
+            profiler.stop()
+        else:
+            profiler.disable()
+        _profiling = False
+        try:
+            await asyncio.to_thread(
+                _write_profile,
+                profiler,
+                name,
+                started,
+                withdraw_settings.profiler_max_files,
+            )
+        except Exception as exc:
+            logger.warning(f"Could not write withdraw profile: {exc!s}")
+
+
+def _write_profile(profiler: Any, name: str, started: float, max_files: int) -> None:
+    directory = profiles_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    filename = f"{int(started * 1000)}-{name}"
+    if HAS_PYINSTRUMENT:
+        path = directory / f"{filename}.speedscope.json"
+        path.write_text(profiler.output(SpeedscopeRenderer()))
+    else:
+        profiler.dump_stats(directory / f"{filename}.prof")
+
+    profiles = sorted(directory.iterdir(), key=lambda p: p.stat().st_mtime)
+    for old in profiles[: max(len(profiles) - max_files, 0)]:
+        old.unlink(missing_ok=True)
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import time
+
+from lnbits.db import POSTGRES, SQLITE, Database
+from loguru import logger
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from .models import WithdrawSettings
+
+# optional read-only copy of the extension database: a postgres streaming replica
+# url, or on sqlite the path of a file kept in sync with `ext_withdraw.sqlite3`
+REPLICA_URL = os.getenv("WITHDRAW_REPLICA_DATABASE_URL", "")
+# seconds between two replica lag measurements
+CHECK_INTERVAL = 5
+
+# state of the replica, exposed to admins through `/api/v1/metrics`
+replica_stats: dict = {"healthy": False, "lag": None, "reads": 0, "fallbacks": 0}
+
+# wallet id -> monotonic time until which its reads stay on the primary
+_pinned: dict[str, float] = {}
+
+
+def create_replica_database(url: str) -> Database:
+    """
+    Same database handle as the primary, with its own engine and its own lock,
+    so replica reads never wait behind the writes of the callback path.
+    """
+    replica = Database("ext_withdraw")
+    if replica.type == SQLITE:
+        replica.path = url.removeprefix("sqlite:///")
+        uri = f"sqlite+aiosqlite:///{replica.path}"
+    else:
+        # a hot standby refuses `CREATE SCHEMA`, all queries are schema qualified
+        replica.schema = None
+        uri = url.replace("postgres://", "postgresql+asyncpg://").replace(
+            "cockroachdb://", "cockroachdb+asyncpg://"
+        )
+    replica.engine = create_async_engine(uri)
+    return replica
+
+
+replica_db: Database | None = (
+    create_replica_database(REPLICA_URL) if REPLICA_URL else None
+)
+
+
+def replica_enabled() -> bool:
+    return replica_db is not None
+
+
+def pin_to_primary(wallet_id: str, max_lag: float) -> None:
+    """
+    Read the wallet's links from the primary until the replica caught up with a
+    write. The lag is only measured every CHECK_INTERVAL, hence the margin.
+    """
+    now = time.monotonic()
+    if len(_pinned) > 10_000:
+        for key in [key for key, until in _pinned.items() if until <= now]:
+            del _pinned[key]
+    _pinned[wallet_id] = now + max_lag + CHECK_INTERVAL
+
+
+def is_pinned(wallet_id: str) -> bool:
+    return _pinned.get(wallet_id, 0) > time.monotonic()
+
+
+def get_replica(*wallet_ids: str) -> Database | None:
+    """The replica if it is healthy and none of the wallets wrote recently."""
+    if not replica_db or not replica_stats["healthy"]:
+        return None
+    if any(is_pinned(wallet_id) for wallet_id in wallet_ids):
+        return None
+    replica_stats["reads"] += 1
+    return replica_db
+
+
+async def measure_replica_lag(replica: Database) -> float:
+    if replica.type == POSTGRES:
+        row: dict = await replica.fetchone(
+            """
+            SELECT CASE
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+            END AS lag
+            """
+        )
+        return float(row["lag"] or 0)
+    # sqlite and cockroach copies have no lag to ask for, only check they answer
+    await replica.fetchone("SELECT id FROM withdraw.settings")
+    return 0
+
+
+async def check_replica(max_lag: float) -> bool:
+    if not replica_db:
+        return False
+    try:
+        lag = await measure_replica_lag(replica_db)
+    except Exception as exc:
+        if replica_stats["healthy"]:
+            logger.warning(f"withdraw replica unavailable: {exc!s}")
+        replica_stats.update(healthy=False, lag=None)
+        return False
+    healthy = lag <= max_lag
+    if replica_stats["healthy"] and not healthy:
+        logger.warning(f"withdraw replica is {lag:.1f}s behind, using the primary.")
+    replica_stats.update(healthy=healthy, lag=lag)
+    return healthy
+
+
+async def run_replica_monitor(settings: WithdrawSettings) -> None:
+    while True:
+        await check_replica(settings.replica_max_lag)
+        await asyncio.sleep(CHECK_INTERVAL)
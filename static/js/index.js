@@ -14,10 +14,17 @@ window.app = Vue.createApp({
     return {
       checker: null,
       withdrawLinks: [],
+      withdrawLinksFilter: '',
       lnurl: '',
       withdrawLinksTable: {
         columns: [
-          {name: 'title', align: 'left', label: 'Title', field: 'title'},
+          {
+            name: 'title',
+            align: 'left',
+            label: 'Title',
+            field: 'title',
+            sortable: true
+          },
           {
             name: 'created_at',
             align: 'left',
@@ -32,32 +39,38 @@ window.app = Vue.createApp({
             name: 'wait_time',
             align: 'right',
             label: 'Wait',
-            field: 'wait_time'
+            field: 'wait_time',
+            sortable: true
           },
           {
             name: 'uses',
             align: 'right',
             label: 'Uses',
-            field: 'uses'
+            field: 'uses',
+            sortable: true
           },
           {
             name: 'uses_left',
             align: 'right',
             label: 'Uses left',
-            field: 'uses_left'
+            field: 'uses_left',
+            sortable: true
           },
           {
             name: 'max_withdrawable',
             align: 'right',
             label: 'Max (sat)',
             field: 'max_withdrawable',
+            sortable: true,
             format: LNbits.utils.formatSat
           }
         ],
         pagination: {
           page: 1,
           rowsPerPage: 10,
-          rowsNumber: 0
+          rowsNumber: 0,
+          sortBy: 'open_time',
+          descending: true
         }
       },
       nfcTagWriting: false,
@@ -69,6 +82,7 @@ window.app = Vue.createApp({
           is_unique: false,
           use_custom: false,
           has_webhook: false,
+          webhook_digest: false,
           enabled: true
         }
       },
@@ -89,29 +103,33 @@ window.app = Vue.createApp({
       }
     }
   },
-  computed: {
-    sortedWithdrawLinks() {
-      return this.withdrawLinks.sort(function (a, b) {
-        return b.uses_left - a.uses_left
-      })
-    }
-  },
   methods: {
+    searchWithdrawLinks() {
+      // a narrower search can have fewer pages than the one shown
+      this.withdrawLinksTable.pagination.page = 1
+      this.getWithdrawLinks()
+    },
     getWithdrawLinks(props) {
       if (props) {
         this.withdrawLinksTable.pagination = props.pagination
       }
 
       let pagination = this.withdrawLinksTable.pagination
-      const query = {
+      const query = new URLSearchParams({
+        all_wallets: true,
         limit: pagination.rowsPerPage,
-        offset: (pagination.page - 1) * pagination.rowsPerPage
+        offset: (pagination.page - 1) * pagination.rowsPerPage,
+        sortby: pagination.sortBy || 'open_time',
+        direction: pagination.descending ? 'desc' : 'asc'
+      })
+      if (this.withdrawLinksFilter) {
+        query.set('title', this.withdrawLinksFilter)
       }
 
       LNbits.api
         .request(
           'GET',
-          `/withdraw/api/v1/links?all_wallets=true&limit=${query.limit}&offset=${query.offset}`,
+          `/withdraw/api/v1/links?${query}`,
           this.g.user.wallets[0].inkey
         )
         .then(response => {
@@ -128,6 +146,7 @@ window.app = Vue.createApp({
         is_unique: false,
         use_custom: false,
         has_webhook: false,
+        webhook_digest: false,
         enabled: true
       }
     },
@@ -209,6 +228,7 @@ window.app = Vue.createApp({
         data.webhook_url = null
         data.webhook_headers = null
         data.webhook_body = null
+        data.webhook_digest = false
       }
 
       LNbits.api
@@ -230,6 +250,25 @@ window.app = Vue.createApp({
           LNbits.utils.notifyApiError(error)
         })
     },
+    toggleWithdrawLink(link) {
+      const wallet = _.findWhere(this.g.user.wallets, {id: link.wallet})
+      // only `enabled` is written, `version` turns a concurrent edit into a 409
+      LNbits.api
+        .request('PATCH', '/withdraw/api/v1/links/' + link.id, wallet.adminkey, {
+          enabled: !link.enabled,
+          version: link.version
+        })
+        .then(response => {
+          const index = this.withdrawLinks.findIndex(obj => obj.id === link.id)
+          this.withdrawLinks.splice(index, 1, mapWithdrawLink(response.data))
+        })
+        .catch(error => {
+          LNbits.utils.notifyApiError(error)
+          if (error.response?.status === 409) {
+            this.getWithdrawLinks()
+          }
+        })
+    },
     createWithdrawLink(wallet, data) {
       LNbits.api
         .request('POST', '/withdraw/api/v1/links', wallet.adminkey, data)
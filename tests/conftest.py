@@ -0,0 +1,126 @@
+import asyncio
+import inspect
+import os
+import random
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+import pytest_asyncio
+from lnbits.db import SQLITE, Database
+from lnbits.helpers import urlsafe_short_hash
+from lnbits.wallets.fake import FakeWallet
+
+from .. import crud, migrations, views_lnurl
+from ..models import CreateWithdrawData, WithdrawLink
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def withdraw_db():
+    """
+    Fresh, migrated extension database. On SQLite this is a separate
+    `ext_withdraw_test` file. On Postgres the `withdraw` schema is dropped, so it
+    only runs with `WITHDRAW_TEST_POSTGRES=1` against a throwaway database.
+    """
+    test_db = Database("ext_withdraw_test")
+    test_db.schema = "withdraw"
+    if test_db.type == SQLITE:
+        if os.path.exists(test_db.path):
+            os.remove(test_db.path)
+    elif os.environ.get("WITHDRAW_TEST_POSTGRES") == "1":
+        await test_db.execute("DROP SCHEMA IF EXISTS withdraw CASCADE")
+    else:
+        pytest.skip("set WITHDRAW_TEST_POSTGRES=1 to run against this database")
+
+    for name, migration in sorted(
+        inspect.getmembers(migrations, inspect.iscoroutinefunction)
+    ):
+        if name.startswith("m0"):
+            async with test_db.connect() as conn:
+                await migration(conn)
+
+    original_db, original_bulk_db = crud.db, crud.bulk_db
+    crud.db = crud.bulk_db = test_db
+    yield test_db
+    crud.db, crud.bulk_db = original_db, original_bulk_db
+    await test_db.engine.dispose()
+
+
+class LinkFactory:
+    """Creates links in a wallet of its own, see the `create_link` fixture."""
+
+    def __init__(self) -> None:
+        self.wallet = f"wallet_{urlsafe_short_hash()[:8]}"
+
+    async def __call__(self, ready: bool = False, **fields: Any) -> WithdrawLink:
+        data = {
+            "title": "test",
+            "min_withdrawable": 10,
+            "max_withdrawable": 100,
+            "uses": 1,
+            "wait_time": 1,
+            "is_unique": False,
+            **fields,
+        }
+        link = await crud.create_withdraw_link(CreateWithdrawData(**data), self.wallet)
+        if ready:
+            # no wait before the first redemption and between the next ones
+            patched = await crud.patch_withdraw_link(
+                link.id, {"wait_time": 0, "open_time": 0}
+            )
+            assert patched
+            link = patched
+        return link
+
+
+@pytest.fixture
+def create_link(withdraw_db) -> LinkFactory:
+    """
+    Link factory on the test database. Every test gets its own wallet, so
+    listings only see the links the test created. Keyword arguments override
+    the `CreateWithdrawData` defaults, `ready=True` makes the link redeemable
+    right away.
+    """
+    return LinkFactory()
+
+
+class PayInvoiceStub:
+    """
+    Stand-in for `pay_invoice` that yields to the loop, for `delay` seconds or
+    a few random milliseconds, and fails at `failure_rate`.
+    """
+
+    def __init__(self, failure_rate: float = 0, delay: float | None = None):
+        self.failure_rate = failure_rate
+        self.delay = delay
+        self.payments: list[dict] = []
+
+    async def __call__(self, **kwargs):
+        await asyncio.sleep(
+            random.uniform(0, 0.005) if self.delay is None else self.delay
+        )
+        if random.random() < self.failure_rate:
+            raise RuntimeError("route not found")
+        self.payments.append(kwargs)
+        return SimpleNamespace(payment_hash=f"hash{len(self.payments)}", extra={})
+
+
+@pytest.fixture
+def pay_stub(monkeypatch):
+    """Replaces `pay_invoice` of the LNURL routes, without callback deadline."""
+    monkeypatch.setattr(crud.withdraw_settings, "callback_deadline", 0)
+
+    def make(failure_rate: float = 0, delay: float | None = None) -> PayInvoiceStub:
+        stub = PayInvoiceStub(failure_rate, delay)
+        monkeypatch.setattr(views_lnurl, "pay_invoice", stub)
+        return stub
+
+    return make
+
+
+@pytest.fixture(scope="session")
+def payment_request() -> str:
+    """A 50 sat invoice."""
+    invoice = asyncio.run(FakeWallet().create_invoice(50))
+    assert invoice.payment_request
+    return invoice.payment_request
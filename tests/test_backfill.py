@@ -0,0 +1,76 @@
+import pytest
+
+from ..backfill import backfill, get_backfills, is_backfill_done
+
+ROWS = 1234
+
+
+class BackfillStoppedError(Exception):
+    pass
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_interrupted_backfill_resumes(withdraw_db):
+    await withdraw_db.execute(
+        "CREATE TABLE withdraw.backfill_source (id TEXT PRIMARY KEY, amount INTEGER)"
+    )
+    await withdraw_db.execute(
+        "CREATE TABLE withdraw.backfill_target (id TEXT PRIMARY KEY, msat INTEGER)"
+    )
+    for start in range(0, ROWS, 500):
+        rows = range(start, min(start + 500, ROWS))
+        await withdraw_db.execute(
+            "INSERT INTO withdraw.backfill_source (id, amount) VALUES "
+            + ", ".join(f"(:id_{i}, :amount_{i})" for i in rows),
+            {
+                **{f"id_{i}": f"row{i:05}" for i in rows},
+                **{f"amount_{i}": i for i in rows},
+            },
+        )
+
+    batches: list[int] = []
+    interrupt_at = [2]
+
+    async def copy(conn, rows):
+        if len(batches) == interrupt_at[0]:
+            raise BackfillStoppedError
+        batches.append(len(rows))
+        for row in rows:
+            await conn.execute(
+                """
+                INSERT INTO withdraw.backfill_target (id, msat)
+                VALUES (:id, :msat) ON CONFLICT (id) DO NOTHING
+                """,
+                {"id": row["id"], "msat": row["amount"] * 1000},
+            )
+
+    with pytest.raises(BackfillStoppedError):
+        await backfill(
+            withdraw_db, "test", "withdraw.backfill_source", copy, batch_size=100
+        )
+    assert not await is_backfill_done(withdraw_db, "test")
+    [progress] = [b for b in await get_backfills(withdraw_db) if b["name"] == "test"]
+    assert progress["processed"] == 200 and progress["total"] == ROWS
+
+    batches.clear()
+    interrupt_at[0] = -1
+    processed = await backfill(
+        withdraw_db,
+        "test",
+        "withdraw.backfill_source",
+        copy,
+        batch_size=100,
+        pause=0.001,
+    )
+    assert processed == ROWS
+    assert sum(batches) == ROWS - 200
+    assert await is_backfill_done(withdraw_db, "test")
+
+    row = await withdraw_db.fetchone(
+        "SELECT COUNT(*) AS count, SUM(msat) AS msat FROM withdraw.backfill_target"
+    )
+    assert row["count"] == ROWS
+    assert row["msat"] == sum(range(ROWS)) * 1000
+
+    # a finished backfill is not run again
+    assert await backfill(withdraw_db, "test", "withdraw.backfill_source", copy) == ROWS
@@ -0,0 +1,89 @@
+import asyncio
+import random
+import time
+from collections import Counter
+
+import pytest
+import shortuuid
+
+from .. import views_lnurl
+from ..crud import get_withdraw_link
+from ..models import WithdrawLink
+
+CONCURRENCY = 300
+
+
+def _voucher(link: WithdrawLink, number: int) -> str:
+    return shortuuid.uuid(name=link.id + link.unique_hash + str(number))
+
+
+async def _fire(link: WithdrawLink, vouchers: list[str | None], pr: str) -> Counter:
+    start = time.perf_counter()
+    responses = await asyncio.gather(
+        *[
+            views_lnurl.api_lnurl_callback(link.unique_hash, link.k1, pr, voucher)
+            for voucher in vouchers
+        ]
+    )
+    elapsed = time.perf_counter() - start
+    outcomes = Counter(getattr(r, "reason", None) or "OK" for r in responses)
+    print(
+        f"\n{len(vouchers)} callbacks in {elapsed:.2f}s "
+        f"({len(vouchers) / elapsed:.0f}/s), outcomes: {dict(outcomes)}"
+    )
+    return outcomes
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_multi_use_link_is_never_over_redeemed(
+    create_link, pay_stub, payment_request
+):
+    stub = pay_stub()
+    link = await create_link(ready=True, uses=3, is_unique=False)
+
+    # one more wave than uses, the last one must not pay anything
+    for _ in range(link.uses + 1):
+        await _fire(link, [None] * CONCURRENCY, payment_request)
+
+    updated = await get_withdraw_link(link.id)
+    assert updated
+    assert len(stub.payments) <= link.uses
+    assert updated.used == len(stub.payments)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_unique_vouchers_are_redeemed_once(
+    create_link, pay_stub, payment_request
+):
+    stub = pay_stub()
+    link = await create_link(ready=True, uses=20, is_unique=True)
+    vouchers = [_voucher(link, i) for i in range(link.uses)]
+
+    outcomes = await _fire(
+        link, [random.choice(vouchers) for _ in range(CONCURRENCY)], payment_request
+    )
+    outcomes += await _fire(link, vouchers * 5, payment_request)
+
+    updated = await get_withdraw_link(link.id)
+    assert updated
+    assert outcomes["OK"] == len(stub.payments) <= link.uses
+    assert updated.used == len(stub.payments)
+    remaining = updated.usescsv.split(",") if updated.usescsv else []
+    assert len(remaining) == link.uses - updated.used
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_failed_payments_release_their_claim(
+    create_link, pay_stub, payment_request
+):
+    stub = pay_stub(failure_rate=0.5)
+    link = await create_link(ready=True, uses=10, is_unique=True)
+    vouchers = [_voucher(link, i) for i in range(link.uses)]
+
+    for _ in range(3):
+        await _fire(link, vouchers * 10, payment_request)
+
+    updated = await get_withdraw_link(link.id)
+    assert updated
+    assert len(stub.payments) <= link.uses
+    assert updated.used == len(stub.payments)
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+
+from .. import deadline, views_lnurl
+from ..crud import get_withdraw_link
+from ..deadline import CallbackDeadline
+from ..helpers import voucher_hashes
+from ..models import SweepVoucher, SweepWithdrawData, WithdrawAttempt
+
+BUDGET = 0.05
+
+
+@pytest.fixture
+def short_deadline(monkeypatch) -> list[WithdrawAttempt]:
+    """Callbacks get BUDGET seconds, returns the journaled attempts."""
+    monkeypatch.setattr(
+        views_lnurl, "CallbackDeadline", lambda _: CallbackDeadline(BUDGET)
+    )
+    journal: list[WithdrawAttempt] = []
+    monkeypatch.setattr(views_lnurl, "record_withdraw_attempt", journal.append)
+    return journal
+
+
+async def _wait_for_detached() -> None:
+    while deadline._detached:
+        await asyncio.sleep(0.01)
+    # the done callbacks run one loop iteration after the task finished
+    await asyncio.sleep(0)
+
+
+async def _hash_check(withdraw_db, the_hash: str) -> dict | None:
+    return await withdraw_db.fetchone(
+        "SELECT id FROM withdraw.hash_check WHERE id = :id", {"id": the_hash}
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_expired_before_payment_releases_the_claim(
+    withdraw_db, create_link, pay_stub, payment_request, short_deadline, monkeypatch
+):
+    stub = pay_stub()
+    claim = views_lnurl.claim_withdraw_link
+
+    async def slow_claim(link, now):
+        claimed = await claim(link, now)
+        await asyncio.sleep(BUDGET * 2)
+        return claimed
+
+    monkeypatch.setattr(views_lnurl, "claim_withdraw_link", slow_claim)
+    link = await create_link(ready=True, uses=2, is_unique=True)
+    voucher = voucher_hashes(link)[0]
+
+    response = await views_lnurl.api_lnurl_callback(
+        link.unique_hash, link.k1, payment_request, voucher
+    )
+    assert response.reason == "Withdraw timed out, please try again."
+    assert not short_deadline
+    await _wait_for_detached()
+
+    assert not stub.payments
+    stored = await get_withdraw_link(link.id)
+    assert stored and stored.used == 0 and voucher in voucher_hashes(stored)
+    assert not await _hash_check(withdraw_db, voucher)
+    [attempt] = short_deadline
+    assert attempt.outcome == "error"
+    assert attempt.reason == "Withdraw timed out, please try again."
+
+
+@pytest.mark.asyncio(loop_scope="session")
+@pytest.mark.parametrize("fails", [False, True])
+async def test_expired_during_payment_is_reconciled(
+    withdraw_db, create_link, pay_stub, payment_request, short_deadline, fails
+):
+    stub = pay_stub(failure_rate=1 if fails else 0, delay=BUDGET * 2)
+    link = await create_link(ready=True, uses=2, is_unique=True)
+    voucher = voucher_hashes(link)[0]
+
+    response = await views_lnurl.api_lnurl_callback(
+        link.unique_hash, link.k1, payment_request, voucher
+    )
+    assert response.reason.startswith("Withdraw is still being processed")
+    await _wait_for_detached()
+
+    stored = await get_withdraw_link(link.id)
+    assert stored
+    [attempt] = short_deadline
+    assert "deadline" in attempt.timings
+    if fails:
+        assert stored.used == 0 and voucher in voucher_hashes(stored)
+        assert not await _hash_check(withdraw_db, voucher)
+        assert attempt.outcome == "error"
+        assert attempt.reason == "withdraw not working. route not found"
+    else:
+        assert len(stub.payments) == 1
+        assert stored.used == 1 and voucher not in voucher_hashes(stored)
+        # kept, the voucher can never be processed again
+        assert await _hash_check(withdraw_db, voucher)
+        assert attempt.outcome == "success"
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_sweep_expired_during_payment_is_reconciled(
+    create_link, pay_stub, payment_request, short_deadline
+):
+    stub = pay_stub(delay=BUDGET * 2)
+    links = [
+        await create_link(ready=True, uses=2, is_unique=True, max_withdrawable=30)
+        for _ in range(2)
+    ]
+    vouchers = [voucher_hashes(link)[0] for link in links]
+    data = SweepWithdrawData(
+        pr=payment_request,
+        vouchers=[
+            SweepVoucher(unique_hash=link.unique_hash, id_unique_hash=voucher)
+            for link, voucher in zip(links, vouchers, strict=True)
+        ],
+    )
+
+    response = await views_lnurl.api_lnurl_sweep(data)
+    assert response.reason.startswith("Withdraw is still being processed")
+    assert not short_deadline
+    await _wait_for_detached()
+
+    assert len(stub.payments) == 1
+    for link, voucher in zip(links, vouchers, strict=True):
+        stored = await get_withdraw_link(link.id)
+        assert stored and stored.used == 1 and voucher not in voucher_hashes(stored)
+    assert [a.voucher_hash for a in short_deadline] == vouchers
+    assert all(
+        a.outcome == "success" and "deadline" in a.timings for a in short_deadline
+    )
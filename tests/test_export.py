@@ -0,0 +1,89 @@
+import csv
+import gzip
+import io
+import json
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+
+from .. import views_api
+from ..crud import iter_withdraw_links
+from ..isolation import isolation_stats
+from ..models import WithdrawLinkFilters
+
+
+@pytest.fixture
+def export(monkeypatch):
+    """Calls the export endpoint for a wallet, two links per chunk."""
+    monkeypatch.setattr(
+        views_api, "iter_withdraw_links", partial(iter_withdraw_links, chunk_size=2)
+    )
+
+    async def call(wallet: str, export_format: str, compress: bool = False):
+        return await views_api.api_links_export(
+            SimpleNamespace(wallet=SimpleNamespace(id=wallet)),  # type: ignore[arg-type]
+            False,
+            export_format,  # type: ignore[arg-type]
+            compress,
+            WithdrawLinkFilters(),
+        )
+
+    return call
+
+
+async def _drain(response) -> bytes:
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    await response.background()
+    return body
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_export_formats(create_link, export):
+    links = [await create_link(title=f"link {i}") for i in range(5)]
+    ids = sorted(link.id for link in links)
+
+    ndjson = await _drain(await export(create_link.wallet, "ndjson"))
+    rows = [json.loads(line) for line in ndjson.splitlines()]
+    assert [row["id"] for row in rows] == ids
+    assert "lnurl" not in rows[0]
+    assert isolation_stats["heavy_running"] == 0
+
+    response = await export(create_link.wallet, "csv")
+    assert response.media_type == "text/csv"
+    table = list(csv.reader(io.StringIO((await _drain(response)).decode())))
+    # one header across the chunks
+    assert table[0] == views_api.EXPORT_FIELDS
+    assert [row[0] for row in table[1:]] == ids
+
+    response = await export(create_link.wallet, "ndjson", compress=True)
+    assert response.media_type == "application/gzip"
+    assert "withdraw-links.ndjson.gz" in response.headers["content-disposition"]
+    assert gzip.decompress(await _drain(response)) == ndjson
+    assert isolation_stats["heavy_running"] == 0
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_export_without_links_is_a_csv_header(export):
+    body = await _drain(await export("wallet without links", "csv", compress=True))
+    assert gzip.decompress(body).decode().strip() == ",".join(views_api.EXPORT_FIELDS)
+    assert isolation_stats["heavy_running"] == 0
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_slot_is_released_when_the_client_disconnects(create_link, export):
+    for i in range(5):
+        await create_link(title=f"link {i}")
+
+    # gone after the first chunk
+    response = await export(create_link.wallet, "ndjson")
+    assert isolation_stats["heavy_running"] == 1
+    await response.body_iterator.__anext__()
+    await response.body_iterator.aclose()
+    assert isolation_stats["heavy_running"] == 0
+
+    # gone before the body was started, only the background task runs
+    response = await export(create_link.wallet, "csv")
+    assert isolation_stats["heavy_running"] == 1
+    await response.background()
+    assert isolation_stats["heavy_running"] == 0
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from lnbits.helpers import urlsafe_short_hash
+
+from .. import journal
+from ..crud import create_withdraw_attempts, get_withdraw_attempts
+from ..journal import flush_withdraw_attempts, record_withdraw_attempt
+from ..models import WithdrawAttempt
+
+NOW = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+@pytest.fixture
+def buffer(monkeypatch) -> list[WithdrawAttempt]:
+    """An empty journal buffer that flushes every 2 attempts."""
+    empty: list[WithdrawAttempt] = []
+    monkeypatch.setattr(journal, "_buffer", empty)
+    monkeypatch.setattr(journal, "FLUSH_SIZE", 2)
+    journal._flush_event.clear()
+    return empty
+
+
+def _attempt(link_id: str, hours_ago: int, outcome: str = "success"):
+    return WithdrawAttempt(
+        id=urlsafe_short_hash(),
+        link_id=link_id,
+        amount_msat=hours_ago * 1000,
+        outcome=outcome,
+        timings={"total": 1.5},
+        created_at=NOW - timedelta(hours=hours_ago),
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_attempts_are_flushed_in_batches_and_queried(buffer, create_link):
+    first, second = await create_link(), await create_link()
+    record_withdraw_attempt(_attempt(first.id, 3))
+    assert not journal._flush_event.is_set()
+    record_withdraw_attempt(_attempt(first.id, 2, "error"))
+    assert journal._flush_event.is_set()
+    record_withdraw_attempt(_attempt(second.id, 1))
+
+    assert await flush_withdraw_attempts() == 2
+    assert len(buffer) == 1
+    assert await flush_withdraw_attempts() == 1
+    assert await flush_withdraw_attempts() == 0
+
+    wallet = create_link.wallet
+    attempts = await get_withdraw_attempts(wallet)
+    assert [a.amount_msat for a in attempts] == [1000, 2000, 3000]
+    assert attempts[1].outcome == "error" and attempts[1].timings == {"total": 1.5}
+
+    by_link = await get_withdraw_attempts(wallet, link_id=first.id)
+    assert [a.amount_msat for a in by_link] == [2000, 3000]
+    # `since` is inclusive and `until` exclusive
+    window = await get_withdraw_attempts(
+        wallet,
+        since=NOW - timedelta(hours=2),
+        until=NOW - timedelta(hours=1),
+    )
+    assert [a.amount_msat for a in window] == [2000]
+    assert await get_withdraw_attempts(wallet, since=NOW) == []
+    assert await get_withdraw_attempts("other wallet") == []
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_failed_flush_puts_the_batch_back(buffer, create_link, monkeypatch):
+    link = await create_link()
+    attempts = [_attempt(link.id, hours) for hours in (3, 2, 1)]
+    for attempt in attempts:
+        record_withdraw_attempt(attempt)
+
+    async def unavailable(batch):
+        raise RuntimeError("database is down")
+
+    monkeypatch.setattr(journal, "create_withdraw_attempts", unavailable)
+    with pytest.raises(RuntimeError):
+        await flush_withdraw_attempts()
+    assert buffer == attempts
+
+    # retried once the database is back
+    monkeypatch.setattr(journal, "create_withdraw_attempts", create_withdraw_attempts)
+    assert await flush_withdraw_attempts() == 2
+    assert await flush_withdraw_attempts() == 1
+    stored = await get_withdraw_attempts(create_link.wallet)
+    assert [a.id for a in stored] == [a.id for a in reversed(attempts)]
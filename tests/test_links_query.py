@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from ..crud import claim_withdraw_link, get_withdraw_links, patch_withdraw_link
+from ..models import WithdrawLinkFilters
+
+
+async def _titles(create_link, **filters) -> list[str | None]:
+    links, total = await get_withdraw_links(
+        [create_link.wallet], 0, 0, WithdrawLinkFilters(**filters)
+    )
+    assert total == len(links)
+    return [link.title for link in links]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_filters(create_link):
+    now = int(datetime.now().timestamp())
+    await create_link(title="50% off", max_withdrawable=100)
+    await create_link(title="500 off", max_withdrawable=200)
+    await create_link(title="gift_card", max_withdrawable=1000, is_unique=True)
+    await create_link(title="giftXcard", max_withdrawable=1000)
+    spent = await create_link(title="spent", ready=True)
+    assert await claim_withdraw_link(spent, now)
+    disabled = await create_link(title="disabled")
+    await patch_withdraw_link(disabled.id, {"enabled": False})
+
+    # LIKE wildcards in the search are matched literally, case is ignored
+    assert await _titles(create_link, title="50%") == ["50% off"]
+    assert await _titles(create_link, title="GIFT_") == ["gift_card"]
+    assert await _titles(create_link, enabled=False) == ["disabled"]
+    assert await _titles(create_link, spent=True) == ["spent"]
+    assert len(await _titles(create_link, spent=False)) == 5
+    assert await _titles(create_link, is_unique=True) == ["gift_card"]
+    assert sorted(await _titles(create_link, amount_min=200, amount_max=999)) == [
+        "500 off"
+    ]
+
+    later = datetime.now(timezone.utc) + timedelta(hours=1)
+    assert await _titles(create_link, created_from=later) == []
+    assert len(await _titles(create_link, created_to=later)) == 6
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_sort_by_uses_left(create_link):
+    now = int(datetime.now().timestamp())
+    await create_link(title="three left", uses=3)
+    one_left = await create_link(title="one left", uses=2, ready=True)
+    assert await claim_withdraw_link(one_left, now)
+    await create_link(title="five left", uses=5)
+
+    assert await _titles(create_link, sortby="uses_left", direction="asc") == [
+        "one left",
+        "three left",
+        "five left",
+    ]
+    assert await _titles(create_link, sortby="uses_left", direction="desc") == [
+        "five left",
+        "three left",
+        "one left",
+    ]
@@ -0,0 +1,67 @@
+import pytest
+
+from ..crud import get_withdraw_link_by_hash
+from ..lookup_filter import BloomFilter, build_lookup_filter, lookup_filter_stats
+
+
+def test_false_positive_rate():
+    bloom = BloomFilter(10_000, 0.01)
+    for i in range(10_000):
+        bloom.add(f"member{i}")
+    assert all(f"member{i}" in bloom for i in range(10_000))
+    false_positives = sum(f"other{i}" in bloom for i in range(10_000))
+    assert false_positives < 200
+    # ~9.6 bits per member at 1%
+    assert 11_000 < len(bloom.bits) < 13_000
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_unknown_hashes_are_rejected(withdraw_db, create_link):
+    before = await create_link()
+    await build_lookup_filter(withdraw_db, 0.001)
+    try:
+        assert lookup_filter_stats["ready"]
+        assert lookup_filter_stats["count"] >= 1
+        # links created after the build are added on creation
+        after = await create_link()
+        for link in (before, after):
+            found = await get_withdraw_link_by_hash(link.unique_hash)
+            assert found and found.id == link.id
+
+        rejected = lookup_filter_stats["rejected"]
+        for i in range(100):
+            assert not await get_withdraw_link_by_hash(f"scanner{i}")
+        assert lookup_filter_stats["rejected"] - rejected >= 99
+    finally:
+        await build_lookup_filter(withdraw_db, 0)
+    assert not lookup_filter_stats["ready"]
+
+
+class _SlowScan:
+    """Database whose build queries race with a link created meanwhile."""
+
+    def __init__(self, db, create_link):
+        self.db = db
+        self.create_link = create_link
+        self.created = None
+
+    async def fetchone(self, query, values=None):
+        row = await self.db.fetchone(query, values)
+        self.created = await self.create_link()
+        return row
+
+    async def fetchall(self, query, values=None):
+        rows = await self.db.fetchall(query, values)
+        # its insert becomes visible only after the scan read past it
+        return [row for row in rows if row["unique_hash"] != self.created.unique_hash]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_link_created_during_the_build_is_kept(withdraw_db, create_link):
+    db = _SlowScan(withdraw_db, create_link)
+    await build_lookup_filter(db, 0.001)  # type: ignore[arg-type]
+    try:
+        found = await get_withdraw_link_by_hash(db.created.unique_hash)
+        assert found and found.id == db.created.id
+    finally:
+        await build_lookup_filter(withdraw_db, 0)
@@ -0,0 +1,85 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+import shortuuid
+
+from .. import views_api
+from ..crud import (
+    claim_withdraw_link,
+    get_withdraw_link,
+    patch_withdraw_link,
+    remove_unique_withdraw_link,
+)
+from ..models import CreateWithdrawData
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_patch_writes_only_given_columns(create_link):
+    link = await create_link(title="toggle", uses=3)
+    # a redemption between reading the link and toggling it is kept
+    assert await claim_withdraw_link(link, int(datetime.now().timestamp()) + 10)
+
+    patched = await patch_withdraw_link(link.id, {"enabled": False}, link.version)
+    assert patched and not patched.enabled
+    assert patched.used == 1 and patched.version == link.version + 1
+    assert patched.title == "toggle"
+
+    # an edit based on the old version is refused
+    assert not await patch_withdraw_link(link.id, {"title": "stale"}, link.version)
+    stored = await get_withdraw_link(link.id)
+    assert stored and stored.title == "toggle" and not stored.enabled
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_patch_uses_resizes_current_vouchers(create_link):
+    link = await create_link(uses=3, is_unique=True)
+    # voucher 0 is redeemed after the admin loaded the link
+    redeemed = await get_withdraw_link(link.id)
+    assert redeemed
+    assert await claim_withdraw_link(redeemed, int(datetime.now().timestamp()) + 10)
+    await remove_unique_withdraw_link(
+        redeemed, shortuuid.uuid(name=link.id + link.unique_hash + "0")
+    )
+
+    patched = await patch_withdraw_link(link.id, {"uses": 4}, link.version)
+    assert patched
+    assert patched.usescsv == "1,2,3"
+
+    with pytest.raises(ValueError):
+        await patch_withdraw_link(link.id, {"uses": 1})
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_put_keeps_concurrent_redemptions(create_link, monkeypatch):
+    monkeypatch.setattr(views_api, "_set_lnurl", lambda link, _: link)
+    link = await create_link(uses=3, is_unique=True)
+    opened = link.open_time
+    get_own_link = views_api._get_own_link
+
+    async def read_then_redeem(link_id, wallet_id):
+        # voucher 0 is redeemed while the update is in flight
+        loaded = await get_own_link(link_id, wallet_id)
+        assert await claim_withdraw_link(link, int(datetime.now().timestamp()) + 10)
+        await remove_unique_withdraw_link(
+            link, shortuuid.uuid(name=link.id + link.unique_hash + "0")
+        )
+        return loaded
+
+    monkeypatch.setattr(views_api, "_get_own_link", read_then_redeem)
+    data = CreateWithdrawData(
+        title="edited",
+        min_withdrawable=link.min_withdrawable,
+        max_withdrawable=link.max_withdrawable,
+        uses=4,
+        wait_time=link.wait_time,
+        is_unique=True,
+    )
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id=create_link.wallet))
+
+    updated = await views_api.api_link_create_or_update(
+        None, data, link.id, key_info  # type: ignore[arg-type]
+    )
+    assert updated.title == "edited" and updated.uses == 4
+    assert updated.used == 1 and updated.open_time > opened
+    assert updated.usescsv == "1,2,3"
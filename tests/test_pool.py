@@ -0,0 +1,59 @@
+import asyncio
+from http import HTTPStatus
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from ..crud import (
+    claim_pooled_withdraw_link,
+    create_withdraw_pool,
+    get_withdraw_link,
+    get_withdraw_links,
+    get_withdraw_pools,
+)
+from ..models import CreateWithdrawPoolData
+from ..pool import refill_withdraw_pools
+from ..views_api import api_pool_create
+
+WALLET = "pool_wallet"
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_concurrent_claims_get_distinct_links(withdraw_db):
+    pool = await create_withdraw_pool(
+        CreateWithdrawPoolData(title="cashback", size=20, max_amount=1000), WALLET
+    )
+    assert await refill_withdraw_pools() == 20
+    # pooled links are not listed until they are claimed
+    assert await get_withdraw_links([WALLET], 0, 0) == ([], 0)
+
+    links = await asyncio.gather(
+        *[claim_pooled_withdraw_link(pool, amount) for amount in range(1, 26)]
+    )
+    assert len({link.id for link in links}) == 25
+    for amount, link in enumerate(links, start=1):
+        stored = await get_withdraw_link(link.id)
+        assert stored and stored.enabled and stored.pool_id is None
+        assert stored.min_withdrawable == stored.max_withdrawable == amount
+
+    # the last 5 claims found the pool empty and created their link
+    [pool] = await get_withdraw_pools(WALLET)
+    assert pool.available == 0
+    assert await refill_withdraw_pools() == 20
+    _, total = await get_withdraw_links([WALLET], 0, 0)
+    assert total == 25
+
+
+@pytest.mark.asyncio(loop_scope="session")
+@pytest.mark.parametrize("field", ["webhook_headers", "webhook_body"])
+async def test_pool_webhook_json_is_validated(withdraw_db, field):
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id="invalid_pool_wallet"))
+    data = CreateWithdrawPoolData(
+        title="broken", max_amount=100, webhook_url="https://example.com"
+    )
+    setattr(data, field, "{not json")
+    with pytest.raises(HTTPException) as exc_info:
+        await api_pool_create(data, key_info)  # type: ignore[arg-type]
+    assert exc_info.value.status_code == HTTPStatus.BAD_REQUEST
+    assert await get_withdraw_pools("invalid_pool_wallet") == []
@@ -0,0 +1,89 @@
+import os
+import sqlite3
+
+import pytest
+import pytest_asyncio
+from lnbits.db import SQLITE
+
+from .. import replica
+from ..crud import (
+    get_withdraw_link,
+    get_withdraw_link_by_hash,
+    get_withdraw_links,
+    patch_withdraw_link,
+)
+
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def sync_replica(withdraw_db, monkeypatch):
+    """A second SQLite file, copied from the test database with the backup API."""
+    if withdraw_db.type != SQLITE:
+        pytest.skip("point WITHDRAW_REPLICA_DATABASE_URL at a postgres replica")
+    path = withdraw_db.path.replace(".sqlite3", "_replica.sqlite3")
+
+    def sync():
+        with sqlite3.connect(withdraw_db.path) as src, sqlite3.connect(path) as dst:
+            src.backup(dst)
+
+    sync()
+    test_replica = replica.create_replica_database(path)
+    monkeypatch.setattr(replica, "replica_db", test_replica)
+    for key, value in {
+        "healthy": False,
+        "lag": None,
+        "reads": 0,
+        "fallbacks": 0,
+    }.items():
+        monkeypatch.setitem(replica.replica_stats, key, value)
+    monkeypatch.setattr(replica, "_pinned", {})
+    assert await replica.check_replica(max_lag=5)
+    yield sync
+    await test_replica.engine.dispose()
+    os.remove(path)
+
+
+async def _rename_on_primary(withdraw_db, link_id: str, title: str) -> None:
+    # bypasses crud, so the wallet is not pinned to the primary
+    await withdraw_db.execute(
+        "UPDATE withdraw.withdraw_link SET title = :title WHERE id = :id",
+        {"id": link_id, "title": title},
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_reads_are_served_by_the_replica(withdraw_db, sync_replica, create_link):
+    link = await create_link(title="before")
+    sync_replica()
+    replica._pinned.clear()
+    await _rename_on_primary(withdraw_db, link.id, "after")
+
+    links, _ = await get_withdraw_links([create_link.wallet], 0, 0)
+    assert [row.title for row in links] == ["before"]
+    replica_link = await get_withdraw_link(link.id, from_replica=True)
+    assert replica_link and replica_link.title == "before"
+    primary_link = await get_withdraw_link(link.id)
+    assert primary_link and primary_link.title == "after"
+
+    # writes through crud read their own writes until the replica caught up
+    await patch_withdraw_link(primary_link.id, {"title": "updated"})
+    links, _ = await get_withdraw_links([create_link.wallet], 0, 0)
+    assert [row.title for row in links] == ["updated"]
+    replica_link = await get_withdraw_link(link.id, from_replica=True)
+    assert replica_link and replica_link.title == "updated"
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_missing_and_unhealthy_replica_fall_back(
+    withdraw_db, sync_replica, create_link
+):
+    link = await create_link(title="new")
+    replica._pinned.clear()
+    found = await get_withdraw_link_by_hash(link.unique_hash, from_replica=True)
+    assert found and found.id == link.id
+    assert replica.replica_stats["fallbacks"] == 1
+
+    sync_replica()
+    await _rename_on_primary(withdraw_db, link.id, "renamed")
+    replica.replica_stats["healthy"] = False
+    links, _ = await get_withdraw_links([create_link.wallet], 0, 0)
+    assert "renamed" in [row.title for row in links]
@@ -0,0 +1,92 @@
+import time
+from datetime import datetime
+
+import lnbits.db
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from lnbits.db import dict_to_model
+
+from ..helpers import WithdrawJSONResponse
+from ..models import (
+    PaginatedWithdraws,
+    WithdrawLink,
+    WithdrawLinkRow,
+    _model_stamps_utc,
+)
+
+ROWS = 10_000
+
+
+def _rows(count: int) -> list[dict]:
+    now = int(datetime.now().timestamp())
+    return [
+        {
+            "id": f"link{i}",
+            "wallet": "wallet",
+            "title": f"voucher {i}",
+            "min_withdrawable": 100,
+            "max_withdrawable": 1000,
+            "uses": 10,
+            "wait_time": 1,
+            "is_unique": i % 2,
+            "unique_hash": f"hash{i}",
+            "k1": f"k1{i}",
+            "open_time": now,
+            "used": i % 10,
+            "usescsv": "0,1,2,3,4,5,6,7,8,9",
+            "webhook_url": None,
+            "webhook_headers": None,
+            "webhook_body": None,
+            "custom_url": None,
+            "created_at": now,
+            "enabled": 1,
+        }
+        for i in range(count)
+    ]
+
+
+def _model_response(rows: list[dict]) -> bytes:
+    links = [dict_to_model(row, WithdrawLink) for row in rows]
+    page = PaginatedWithdraws(data=links, total=len(links))
+    return bytes(JSONResponse(jsonable_encoder(page)).body)
+
+
+def _row_response(rows: list[dict]) -> bytes:
+    links = [WithdrawLinkRow.from_row(row) for row in rows]
+    return bytes(WithdrawJSONResponse({"data": links, "total": len(links)}).body)
+
+
+def test_row_serialization_matches_model():
+    rows = _rows(10)
+    assert _row_response(rows) == _model_response(rows)
+
+
+def test_row_timestamps_match_model_on_postgres(monkeypatch):
+    # postgres returns naive datetimes, rows must treat them like the model does
+    monkeypatch.setattr(lnbits.db, "DB_TYPE", lnbits.db.POSTGRES)
+    _model_stamps_utc.cache_clear()
+    try:
+        row = {**_rows(1)[0], "created_at": datetime(2024, 5, 1, 12, 30)}
+        expected = dict_to_model(row, WithdrawLink).created_at
+        assert WithdrawLinkRow.from_row(row).created_at == expected
+        assert WithdrawLinkRow.from_row(row).created_at.tzinfo == expected.tzinfo
+    finally:
+        _model_stamps_utc.cache_clear()
+
+
+def test_row_serialization_benchmark():
+    rows = _rows(ROWS)
+
+    start = time.perf_counter()
+    _model_response(rows)
+    model_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _row_response(rows)
+    row_time = time.perf_counter() - start
+
+    print(
+        f"\n{ROWS} links: models {model_time * 1000:.1f}ms, "
+        f"rows {row_time * 1000:.1f}ms, speedup {model_time / row_time:.1f}x"
+    )
+    assert row_time < model_time
@@ -0,0 +1,126 @@
+from types import SimpleNamespace
+
+import pytest
+from lnurl import LnurlSuccessResponse
+
+from .. import views_lnurl
+from ..crud import get_withdraw_link
+from ..helpers import voucher_hashes
+from ..models import (
+    SweepVoucher,
+    SweepWithdrawData,
+    VoucherStatusQuery,
+    WithdrawAttempt,
+)
+from ..views_api import api_voucher_status
+
+
+@pytest.fixture
+def journal(monkeypatch) -> list[WithdrawAttempt]:
+    """Returns the attempts the sweeps journal."""
+    attempts: list[WithdrawAttempt] = []
+    monkeypatch.setattr(views_lnurl, "record_withdraw_attempt", attempts.append)
+    return attempts
+
+
+def _sweep(pr: str, *links) -> SweepWithdrawData:
+    return SweepWithdrawData(
+        pr=pr,
+        vouchers=[
+            SweepVoucher(unique_hash=link.unique_hash, id_unique_hash=voucher)
+            for link in links
+            for voucher in voucher_hashes(link)[:1]
+        ],
+    )
+
+
+async def _claims(withdraw_db, link) -> list[dict]:
+    return await withdraw_db.fetchall(
+        "SELECT id, lnurl_id FROM withdraw.hash_check WHERE id IN (:a, :b)",
+        dict(zip("ab", voucher_hashes(link)[:2], strict=True)),
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_sweep_of_several_links(
+    withdraw_db, create_link, pay_stub, payment_request, journal
+):
+    stub = pay_stub()
+    # the 50 sat invoice is within 2 * 10 and 2 * 30 sats
+    first, second = [
+        await create_link(ready=True, uses=2, is_unique=True, max_withdrawable=30)
+        for _ in range(2)
+    ]
+
+    response = await views_lnurl.api_lnurl_sweep(_sweep(payment_request, first, second))
+    assert isinstance(response, LnurlSuccessResponse)
+    [payment] = stub.payments
+    assert payment["max_sat"] == 60
+    # payments are found by their first link as well
+    assert payment["extra"]["withdrawal_link_id"] == first.id
+    assert payment["extra"]["withdrawal_link_ids"] == [first.id, second.id]
+
+    # one journal entry per voucher
+    assert [(a.link_id, a.outcome) for a in journal] == [
+        (first.id, "success"),
+        (second.id, "success"),
+    ]
+    assert [a.voucher_hash for a in journal] == [
+        voucher_hashes(link)[0] for link in (first, second)
+    ]
+    assert all(a.amount_msat == 25_000 and "pay" in a.timings for a in journal)
+
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id=create_link.wallet))
+    for link in (first, second):
+        stored = await get_withdraw_link(link.id)
+        assert stored and stored.used == 1
+        # every voucher is claimed with the k1 of its own link
+        [claim] = await _claims(withdraw_db, link)
+        assert claim["lnurl_id"] == link.k1
+        status = await api_voucher_status(
+            link.id,
+            VoucherStatusQuery(hashes=voucher_hashes(link)),
+            key_info,  # type: ignore[arg-type]
+        )
+        assert status.states == "ra"
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_sweep_amount_must_match_the_vouchers(
+    withdraw_db, create_link, pay_stub, payment_request
+):
+    stub = pay_stub()
+    # at most 2 * 20 sats, less than the 50 sat invoice
+    first, second = [
+        await create_link(ready=True, uses=2, is_unique=True, max_withdrawable=20)
+        for _ in range(2)
+    ]
+
+    response = await views_lnurl.api_lnurl_sweep(_sweep(payment_request, first, second))
+    assert response.reason == "Amount not within limits."
+    assert not stub.payments
+    for link in (first, second):
+        stored = await get_withdraw_link(link.id)
+        assert stored and stored.used == 0
+        assert not await _claims(withdraw_db, link)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_failed_sweep_payment_releases_every_claim(
+    withdraw_db, create_link, pay_stub, payment_request, journal
+):
+    pay_stub(failure_rate=1)
+    first, second = [
+        await create_link(ready=True, uses=2, is_unique=True, max_withdrawable=30)
+        for _ in range(2)
+    ]
+
+    response = await views_lnurl.api_lnurl_sweep(_sweep(payment_request, first, second))
+    assert response.reason == "withdraw not working. route not found"
+    assert len(journal) == 2
+    assert all(a.outcome == "error" and a.reason == response.reason for a in journal)
+    for link in (first, second):
+        stored = await get_withdraw_link(link.id)
+        assert stored and stored.used == 0 and stored.open_time == link.open_time
+        assert stored.usescsv == link.usescsv
+        assert not await _claims(withdraw_db, link)
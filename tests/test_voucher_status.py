@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+import pytest
+import shortuuid
+
+from ..crud import create_hash_check, remove_unique_withdraw_link
+from ..helpers import voucher_hashes
+from ..models import VoucherStatusQuery
+from ..views_api import api_voucher_status
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_voucher_states(create_link):
+    link = await create_link(uses=4, is_unique=True)
+    hashes = voucher_hashes(link)
+    # voucher 0 is paid out, voucher 1 is claimed and its payment in flight
+    await create_hash_check(hashes[0], link.k1)
+    await remove_unique_withdraw_link(link, hashes[0])
+    await create_hash_check(hashes[1], link.k1)
+    # checks through `api_hash_retrieve` of other links are not claims
+    await create_hash_check(hashes[2], "other k1")
+
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id=create_link.wallet))
+    status = await api_voucher_status(
+        link.id,
+        VoucherStatusQuery(hashes=[*hashes, "unknown", hashes[3]]),
+        key_info,  # type: ignore[arg-type]
+    )
+    assert status.states == "rpaaua"
+    assert status.uses == 4
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_vouchers_redeemed_before_claims_were_kept(create_link):
+    link = await create_link(uses=4, is_unique=True)
+    hashes = voucher_hashes(link)
+    # the old callback dropped redeemed vouchers from `usescsv` and deleted their
+    # `hash_check` row, here voucher 1 and the last one
+    await remove_unique_withdraw_link(link, hashes[1], hashes[3])
+    not_issued = shortuuid.uuid(name=link.id + link.unique_hash + "4")
+
+    key_info = SimpleNamespace(wallet=SimpleNamespace(id=create_link.wallet))
+    status = await api_voucher_status(
+        link.id,
+        VoucherStatusQuery(hashes=[*hashes, not_issued, "unknown"]),
+        key_info,  # type: ignore[arg-type]
+    )
+    assert status.states == "araruu"
@@ -0,0 +1,90 @@
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from .. import webhooks
+from ..crud import withdraw_settings
+from ..models import WithdrawLink
+
+
+@pytest.fixture
+def receiver(monkeypatch) -> list[dict]:
+    """Webhook receiver and payment store stand-ins, returns the received bodies."""
+    received: list[dict] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        received.append(json.loads(request.content))
+        return httpx.Response(200)
+
+    transport = httpx.MockTransport(handler)
+    client = httpx.AsyncClient
+    monkeypatch.setattr(
+        webhooks.httpx, "AsyncClient", lambda: client(transport=transport)
+    )
+
+    async def update_payment(payment):
+        payment.updates += 1
+
+    monkeypatch.setattr(webhooks, "update_payment", update_payment)
+    monkeypatch.setattr(webhooks, "_digests", {})
+    monkeypatch.setattr(withdraw_settings, "webhook_digest_size", 3)
+    monkeypatch.setattr(withdraw_settings, "webhook_digest_interval", 10)
+    return received
+
+
+def _link(**fields) -> WithdrawLink:
+    return WithdrawLink(
+        id="hooked",
+        created_at=datetime.now(),
+        webhook_url="https://receiver.test/hook",
+        webhook_digest=True,
+        **fields,
+    )
+
+
+def _payments(count: int) -> list[SimpleNamespace]:
+    return [
+        SimpleNamespace(payment_hash=f"hash{i}", extra={}, updates=0)
+        for i in range(count)
+    ]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_digests_flush_by_size_then_interval(receiver):
+    link = _link(webhook_body='{"shop": 1}')
+    payments = _payments(7)
+    for payment in payments:
+        webhooks.queue_webhook(link, payment, "lnbc1")  # type: ignore[arg-type]
+
+    # two full digests go out, the last event waits for the interval
+    assert await webhooks.flush_webhook_digests() == 2
+    assert [len(body["payments"]) for body in receiver] == [3, 3]
+    assert receiver[0]["body"] == {"shop": 1}
+    assert all(p.extra["wh_success"] and p.updates == 1 for p in payments[:6])
+    assert not payments[6].extra
+    assert await webhooks.flush_webhook_digests() == 0
+
+    webhooks._digests[link.id].started -= withdraw_settings.webhook_digest_interval
+    assert await webhooks.flush_webhook_digests() == 1
+    assert receiver[2]["payments"] == [
+        {"payment_hash": "hash6", "payment_request": "lnbc1", "lnurlw": link.id}
+    ]
+    assert payments[6].extra["wh_success"] and not webhooks._digests
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_bad_stored_body_is_recorded_on_every_payment(receiver):
+    link = _link(webhook_body="{not json")
+    payments = _payments(2)
+    for payment in payments:
+        webhooks.queue_webhook(link, payment, "lnbc1")  # type: ignore[arg-type]
+
+    assert await webhooks.flush_webhook_digests(flush_all=True) == 1
+    assert not receiver
+    for payment in payments:
+        assert payment.extra["wh_success"] is False
+        assert payment.extra["wh_message"]
+        assert payment.updates == 1
@@ -6,9 +6,12 @@ from fastapi.responses import HTMLResponse, StreamingResponse
 from lnbits.core.models import User
 from lnbits.decorators import check_user_exists
 from lnbits.helpers import template_renderer
+from lnurl import Lnurl
 
 from .crud import chunks, get_withdraw_link
-from .helpers import create_lnurl
+from .helpers import create_lnurl, voucher_lnurls
+from .isolation import heavy_slot, run_in_encoder
+from .models import WithdrawLink
 
 withdraw_ext_generic = APIRouter()
 
@@ -26,7 +29,7 @@ async def index(request: Request, user: User = Depends(check_user_exists)):
 
 @withdraw_ext_generic.get("/{link_id}", response_class=HTMLResponse)
 async def display(request: Request, link_id):
-    link = await get_withdraw_link(link_id, 0)
+    link = await get_withdraw_link(link_id, 0, from_replica=True)
 
     if not link:
         raise HTTPException(
@@ -52,9 +55,21 @@ async def display(request: Request, link_id):
     )
 
 
+async def _voucher_lnurls(link: WithdrawLink, request: Request) -> list[Lnurl]:
+    # prints and csv files of large links are capped and encoded off the loop
+    async with heavy_slot():
+        try:
+            return await run_in_encoder(voucher_lnurls, link, request)
+        except ValueError as exc:
+            raise HTTPException(
+                status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+                detail=str(exc),
+            ) from exc
+
+
 @withdraw_ext_generic.get("/print/{link_id}", response_class=HTMLResponse)
 async def print_qr(request: Request, link_id):
-    link = await get_withdraw_link(link_id)
+    link = await get_withdraw_link(link_id, from_replica=True)
     if not link:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Withdraw link does not exist."
@@ -65,24 +80,7 @@ async def print_qr(request: Request, link_id):
             "withdraw/print_qr.html",
             {"request": request, "link": link.json(), "unique": False},
         )
-    links = []
-    count = 0
-
-    for _ in link.usescsv.split(","):
-        linkk = await get_withdraw_link(link_id, count)
-        if not linkk:
-            raise HTTPException(
-                status_code=HTTPStatus.NOT_FOUND, detail="Withdraw link does not exist."
-            )
-        try:
-            lnurl = create_lnurl(linkk, request)
-        except ValueError as exc:
-            raise HTTPException(
-                status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
-                detail=str(exc),
-            ) from exc
-        links.append(str(lnurl.bech32))
-        count = count + 1
+    links = [str(lnurl.bech32) for lnurl in await _voucher_lnurls(link, request)]
     page_link = list(chunks(links, 2))
     linked = list(chunks(page_link, 5))
 
@@ -105,7 +103,7 @@ async def print_qr(request: Request, link_id):
 
 @withdraw_ext_generic.get("/csv/{link_id}", response_class=HTMLResponse)
 async def csv(request: Request, link_id):
-    link = await get_withdraw_link(link_id)
+    link = await get_withdraw_link(link_id, from_replica=True)
     if not link:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Withdraw link does not exist."
@@ -117,22 +115,8 @@ async def csv(request: Request, link_id):
         )
 
     buffer = io.StringIO()
-    count = 0
-    for _ in link.usescsv.split(","):
-        linkk = await get_withdraw_link(link_id, count)
-        if not linkk:
-            raise HTTPException(
-                status_code=HTTPStatus.NOT_FOUND, detail="Withdraw link does not exist."
-            )
-        try:
-            lnurl = create_lnurl(linkk, request)
-        except ValueError as exc:
-            raise HTTPException(
-                status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
-                detail=str(exc),
-            ) from exc
+    for lnurl in await _voucher_lnurls(link, request):
         buffer.write(f"{lnurl.bech32!s}\n")
-        count += 1
 
     # Move buffer cursor to the beginning
     buffer.seek(0)
@@ -1,54 +1,122 @@
+import csv
+import io
 import json
+import zlib
+from collections.abc import AsyncIterator, Callable
+from dataclasses import fields
+from datetime import datetime
 from http import HTTPStatus
+from typing import Literal
 
 from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from lnbits.core.crud import get_user
 from lnbits.core.models import SimpleStatus, WalletTypeInfo
-from lnbits.decorators import require_admin_key, require_invoice_key
+from lnbits.decorators import check_admin, require_admin_key, require_invoice_key
+from starlette.background import BackgroundTask
 
+from .backfill import get_backfills
 from .crud import (
+    claim_pooled_withdraw_link,
     create_withdraw_link,
+    create_withdraw_pool,
+    db,
     delete_withdraw_link,
+    delete_withdraw_pool,
+    get_claimed_vouchers,
     get_hash_check,
+    get_withdraw_attempts,
     get_withdraw_link,
     get_withdraw_links,
-    update_withdraw_link,
+    get_withdraw_pool,
+    get_withdraw_pools,
+    get_withdraw_settings,
+    iter_withdraw_links,
+    patch_withdraw_link,
+    update_withdraw_settings,
 )
-from .helpers import create_lnurl
-from .models import CreateWithdrawData, HashCheck, PaginatedWithdraws, WithdrawLink
+from .deadline import deadline_stats
+from .helpers import (
+    WithdrawJSONResponse,
+    create_lnurl,
+    issued_voucher_hashes,
+    json_dumps,
+    voucher_hashes,
+)
+from .isolation import (
+    HEAVY_LISTING,
+    acquire_heavy_slot,
+    heavy_slot,
+    isolation_stats,
+    run_in_encoder,
+)
+from .lookup_filter import lookup_filter_stats
+from .models import (
+    ClaimWithdrawPoolData,
+    CreateWithdrawData,
+    CreateWithdrawPoolData,
+    HashCheck,
+    PaginatedWithdraws,
+    UpdateWithdrawData,
+    VoucherStatus,
+    VoucherStatusQuery,
+    WithdrawAttempt,
+    WithdrawLink,
+    WithdrawLinkFilters,
+    WithdrawLinkRow,
+    WithdrawPool,
+    WithdrawSettings,
+)
+from .pool import request_pool_refill
+from .profiler import ProfiledRoute
+from .replica import replica_stats
 
-withdraw_ext_api = APIRouter(prefix="/api/v1")
+withdraw_ext_api = APIRouter(prefix="/api/v1", route_class=ProfiledRoute)
 
 
-@withdraw_ext_api.get("/links", status_code=HTTPStatus.OK)
+@withdraw_ext_api.get(
+    "/links",
+    status_code=HTTPStatus.OK,
+    response_model=PaginatedWithdraws,
+    response_class=WithdrawJSONResponse,
+)
 async def api_links(
     request: Request,
     key_info: WalletTypeInfo = Depends(require_invoice_key),
     all_wallets: bool = Query(False),
     offset: int = Query(0),
     limit: int = Query(0),
-) -> PaginatedWithdraws:
+    filters: WithdrawLinkFilters = Depends(),
+) -> WithdrawJSONResponse:
     wallet_ids = [key_info.wallet.id]
 
     if all_wallets:
         user = await get_user(key_info.wallet.user)
         wallet_ids = user.wallet_ids if user else []
 
-    links = await get_withdraw_links(wallet_ids, limit, offset)
-
-    for linkk in links.data:
+    heavy = limit == 0 or limit > HEAVY_LISTING
+    async with heavy_slot(heavy):
+        links, total = await get_withdraw_links(wallet_ids, limit, offset, filters)
         try:
-            lnurl = create_lnurl(linkk, request)
+            if heavy:
+                await run_in_encoder(_add_lnurls, links, request)
+            else:
+                _add_lnurls(links, request)
         except ValueError as exc:
             raise HTTPException(
                 status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
                 detail=str(exc),
             ) from exc
+
+    return WithdrawJSONResponse({"data": links, "total": total})
+
+
+def _add_lnurls(links: list[WithdrawLinkRow], request: Request) -> None:
+    for linkk in links:
+        lnurl = create_lnurl(linkk, request)
         linkk.lnurl = str(lnurl.bech32)
         linkk.lnurl_url = str(lnurl.url)
 
-    return links
-
 
 @withdraw_ext_api.get("/links/{link_id}", status_code=HTTPStatus.OK)
 async def api_link_retrieve(
@@ -56,7 +124,7 @@ async def api_link_retrieve(
     link_id: str,
     key_info: WalletTypeInfo = Depends(require_invoice_key),
 ) -> WithdrawLink:
-    link = await get_withdraw_link(link_id, 0)
+    link = await get_withdraw_link(link_id, 0, from_replica=True)
 
     if not link:
         raise HTTPException(
@@ -80,14 +148,11 @@ async def api_link_retrieve(
     return link
 
 
-@withdraw_ext_api.post("/links", status_code=HTTPStatus.CREATED)
-@withdraw_ext_api.put("/links/{link_id}")
-async def api_link_create_or_update(
-    request: Request,
-    data: CreateWithdrawData,
-    link_id: str | None = None,
-    key_info: WalletTypeInfo = Depends(require_admin_key),
-) -> WithdrawLink:
+def _check_link_data(
+    data: CreateWithdrawData | WithdrawLink,
+    webhook_headers: str | None,
+    webhook_body: str | None,
+) -> None:
     if data.uses > 250:
         raise HTTPException(detail="250 uses max.", status_code=HTTPStatus.BAD_REQUEST)
 
@@ -102,63 +167,43 @@ async def api_link_create_or_update(
             status_code=HTTPStatus.BAD_REQUEST,
         )
 
-    if data.webhook_body:
+    _check_webhook_json(webhook_headers, webhook_body)
+
+
+def _check_webhook_json(webhook_headers: str | None, webhook_body: str | None) -> None:
+    if webhook_body:
         try:
-            json.loads(data.webhook_body)
+            json.loads(webhook_body)
         except Exception as exc:
             raise HTTPException(
                 detail="`webhook_body` can not parse JSON.",
                 status_code=HTTPStatus.BAD_REQUEST,
             ) from exc
 
-    if data.webhook_headers:
+    if webhook_headers:
         try:
-            json.loads(data.webhook_headers)
+            json.loads(webhook_headers)
         except Exception as exc:
             raise HTTPException(
                 detail="`webhook_headers` can not parse JSON.",
                 status_code=HTTPStatus.BAD_REQUEST,
             ) from exc
 
-    if link_id:
-        link = await get_withdraw_link(link_id, 0)
-        if not link:
-            raise HTTPException(
-                detail="Withdraw link does not exist.", status_code=HTTPStatus.NOT_FOUND
-            )
-        if link.wallet != key_info.wallet.id:
-            raise HTTPException(
-                detail="Not your withdraw link.", status_code=HTTPStatus.FORBIDDEN
-            )
 
-        if link.uses > data.uses:
-            if data.uses - link.used <= 0:
-                raise HTTPException(
-                    detail="Cannot reduce uses below current used.",
-                    status_code=HTTPStatus.BAD_REQUEST,
-                )
-            numbers = link.usescsv.split(",")
-            link.usescsv = ",".join(numbers[: data.uses - link.used])
-
-        if link.uses < data.uses:
-            numbers = link.usescsv.split(",")
-            if numbers[-1] == "":
-                current_number = int(link.uses)
-                numbers[-1] = str(link.uses)
-            else:
-                current_number = int(numbers[-1])
-            while len(numbers) < (data.uses - link.used):
-                current_number += 1
-                numbers.append(str(current_number))
-            link.usescsv = ",".join(numbers)
+async def _get_own_link(link_id: str, wallet_id: str) -> WithdrawLink:
+    link = await get_withdraw_link(link_id, 0)
+    if not link:
+        raise HTTPException(
+            detail="Withdraw link does not exist.", status_code=HTTPStatus.NOT_FOUND
+        )
+    if link.wallet != wallet_id:
+        raise HTTPException(
+            detail="Not your withdraw link.", status_code=HTTPStatus.FORBIDDEN
+        )
+    return link
 
-        for k, v in data.dict().items():
-            if v is not None:
-                setattr(link, k, v)
 
-        link = await update_withdraw_link(link)
-    else:
-        link = await create_withdraw_link(wallet_id=key_info.wallet.id, data=data)
+def _set_lnurl(link: WithdrawLink, request: Request) -> WithdrawLink:
     try:
         lnurl = create_lnurl(link, request)
     except ValueError as exc:
@@ -173,6 +218,93 @@ async def api_link_create_or_update(
     return link
 
 
+@withdraw_ext_api.post("/links", status_code=HTTPStatus.CREATED)
+@withdraw_ext_api.put("/links/{link_id}")
+async def api_link_create_or_update(
+    request: Request,
+    data: CreateWithdrawData,
+    link_id: str | None = None,
+    key_info: WalletTypeInfo = Depends(require_admin_key),
+) -> WithdrawLink:
+    _check_link_data(data, data.webhook_headers, data.webhook_body)
+
+    if link_id:
+        await _get_own_link(link_id, key_info.wallet.id)
+        # only the edited columns are written, `used`, `open_time` and `usescsv`
+        # stay with concurrent redemptions
+        changes = {k: v for k, v in data.dict().items() if v is not None}
+        try:
+            updated = await patch_withdraw_link(link_id, changes)
+        except ValueError as exc:
+            raise HTTPException(
+                detail=str(exc), status_code=HTTPStatus.BAD_REQUEST
+            ) from exc
+        if not updated:
+            raise HTTPException(
+                detail="Withdraw link does not exist.", status_code=HTTPStatus.NOT_FOUND
+            )
+        link = updated
+    else:
+        link = await create_withdraw_link(wallet_id=key_info.wallet.id, data=data)
+
+    return _set_lnurl(link, request)
+
+
+# columns that can not be set to null by a PATCH
+REQUIRED_LINK_FIELDS = {
+    "title",
+    "min_withdrawable",
+    "max_withdrawable",
+    "uses",
+    "wait_time",
+    "is_unique",
+    "webhook_digest",
+    "enabled",
+}
+
+
+@withdraw_ext_api.patch("/links/{link_id}")
+async def api_link_patch(
+    request: Request,
+    link_id: str,
+    data: UpdateWithdrawData,
+    key_info: WalletTypeInfo = Depends(require_admin_key),
+) -> WithdrawLink:
+    changes = data.dict(exclude_unset=True)
+    version = changes.pop("version", None)
+    for key, value in changes.items():
+        if value is None and key in REQUIRED_LINK_FIELDS:
+            raise HTTPException(
+                detail=f"`{key}` can not be null.",
+                status_code=HTTPStatus.BAD_REQUEST,
+            )
+    if not changes:
+        raise HTTPException(
+            detail="Nothing to update.", status_code=HTTPStatus.BAD_REQUEST
+        )
+
+    link = await _get_own_link(link_id, key_info.wallet.id)
+    _check_link_data(
+        link.copy(update=changes),
+        changes.get("webhook_headers"),
+        changes.get("webhook_body"),
+    )
+
+    try:
+        patched = await patch_withdraw_link(link_id, changes, version)
+    except ValueError as exc:
+        raise HTTPException(
+            detail=str(exc), status_code=HTTPStatus.BAD_REQUEST
+        ) from exc
+    if not patched:
+        raise HTTPException(
+            detail="Withdraw link was changed meanwhile, reload it and try again.",
+            status_code=HTTPStatus.CONFLICT,
+        )
+
+    return _set_lnurl(patched, request)
+
+
 @withdraw_ext_api.delete("/links/{link_id}")
 async def api_link_delete(
     link_id: str, key_info: WalletTypeInfo = Depends(require_admin_key)
@@ -193,6 +325,20 @@ async def api_link_delete(
     return SimpleStatus(success=True, message="Withdraw link deleted.")
 
 
+@withdraw_ext_api.get("/attempts", status_code=HTTPStatus.OK)
+async def api_attempts(
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    link_id: str | None = Query(None),
+    since: datetime | None = Query(None),
+    until: datetime | None = Query(None),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+) -> list[WithdrawAttempt]:
+    return await get_withdraw_attempts(
+        key_info.wallet.id, link_id, since, until, limit, offset
+    )
+
+
 @withdraw_ext_api.get(
     "/links/{the_hash}/{lnurl_id}",
     status_code=HTTPStatus.OK,
@@ -201,3 +347,209 @@ async def api_link_delete(
 async def api_hash_retrieve(the_hash, lnurl_id) -> HashCheck:
     hash_check = await get_hash_check(the_hash, lnurl_id)
     return hash_check
+
+
+@withdraw_ext_api.post("/links/{link_id}/vouchers/status", status_code=HTTPStatus.OK)
+async def api_voucher_status(
+    link_id: str,
+    data: VoucherStatusQuery,
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> VoucherStatus:
+    """Read-only state of many vouchers of a link, unlike `api_hash_retrieve`."""
+    link = await _get_own_link(link_id, key_info.wallet.id)
+    unused = set(voucher_hashes(link))
+    claimed = await get_claimed_vouchers(link.k1, list(set(data.hashes)))
+    issued: set[str] | None = None
+    states = []
+    for the_hash in data.hashes:
+        if the_hash in claimed:
+            # the voucher leaves `usescsv` once its payment went through
+            states.append("p" if the_hash in unused else "r")
+        elif the_hash in unused:
+            states.append("a")
+        else:
+            # vouchers redeemed before claims were kept have no `hash_check` row
+            if issued is None:
+                issued = issued_voucher_hashes(link)
+            states.append("r" if the_hash in issued else "u")
+    return VoucherStatus(uses=link.uses, used=link.used, states="".join(states))
+
+
+@withdraw_ext_api.get("/settings", dependencies=[Depends(check_admin)])
+async def api_get_settings() -> WithdrawSettings:
+    return await get_withdraw_settings()
+
+
+@withdraw_ext_api.put("/settings", dependencies=[Depends(check_admin)])
+async def api_update_settings(data: WithdrawSettings) -> WithdrawSettings:
+    return await update_withdraw_settings(data)
+
+
+@withdraw_ext_api.get("/metrics", dependencies=[Depends(check_admin)])
+async def api_metrics() -> dict:
+    return {
+        "deadline": deadline_stats,
+        "replica": replica_stats,
+        "isolation": isolation_stats,
+        "lookup_filter": lookup_filter_stats,
+        "backfills": await get_backfills(db),
+    }
+
+
+@withdraw_ext_api.get(
+    "/export",
+    status_code=HTTPStatus.OK,
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}, "text/csv": {}}}},
+)
+async def api_links_export(
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+    all_wallets: bool = Query(False),
+    export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+    compress: bool = Query(False, alias="gzip"),
+    filters: WithdrawLinkFilters = Depends(),
+) -> StreamingResponse:
+    wallet_ids = [key_info.wallet.id]
+
+    if all_wallets:
+        user = await get_user(key_info.wallet.user)
+        wallet_ids = user.wallet_ids if user else []
+
+    release = await acquire_heavy_slot()
+    chunks = iter_withdraw_links(wallet_ids, filters)
+    body = _export_csv(chunks) if export_format == "csv" else _export_ndjson(chunks)
+    filename = f"withdraw-links.{export_format}"
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    if compress:
+        body = _gzip(body)
+        filename += ".gz"
+        media_type = "application/gzip"
+
+    return StreamingResponse(
+        _release_after(body, release),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+        # also runs when the client disconnects before the body was started
+        background=BackgroundTask(release),
+    )
+
+
+EXPORT_FIELDS = [
+    f.name
+    for f in fields(WithdrawLinkRow)
+    if f.name not in {"number", "lnurl", "lnurl_url"}
+]
+
+
+def _ndjson_lines(links: list[WithdrawLinkRow]) -> bytes:
+    return b"".join(
+        json_dumps({key: getattr(link, key) for key in EXPORT_FIELDS}) + b"\n"
+        for link in links
+    )
+
+
+async def _export_ndjson(
+    chunks: AsyncIterator[list[WithdrawLinkRow]],
+) -> AsyncIterator[bytes]:
+    async for links in chunks:
+        yield await run_in_encoder(_ndjson_lines, links)
+
+
+def _csv_rows(links: list[WithdrawLinkRow], header: bool = False) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+    writer.writerows([getattr(link, key) for key in EXPORT_FIELDS] for link in links)
+    return buffer.getvalue().encode()
+
+
+async def _export_csv(
+    chunks: AsyncIterator[list[WithdrawLinkRow]],
+) -> AsyncIterator[bytes]:
+    header = True
+    async for links in chunks:
+        yield await run_in_encoder(_csv_rows, links, header)
+        header = False
+    # header only, when there are no links
+    if header:
+        yield _csv_rows([], header)
+
+
+async def _gzip(body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+    async for data in body:
+        compressed = await run_in_encoder(compressor.compress, data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+async def _release_after(
+    body: AsyncIterator[bytes], release: Callable[[], None]
+) -> AsyncIterator[bytes]:
+    try:
+        async for data in body:
+            yield data
+    finally:
+        release()
+
+
+@withdraw_ext_api.get("/pools", status_code=HTTPStatus.OK)
+async def api_pools(
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> list[WithdrawPool]:
+    return await get_withdraw_pools(key_info.wallet.id)
+
+
+@withdraw_ext_api.post("/pools", status_code=HTTPStatus.CREATED)
+async def api_pool_create(
+    data: CreateWithdrawPoolData,
+    key_info: WalletTypeInfo = Depends(require_admin_key),
+) -> WithdrawPool:
+    # every link claimed from the pool inherits its webhook
+    _check_webhook_json(data.webhook_headers, data.webhook_body)
+    pool = await create_withdraw_pool(data, key_info.wallet.id)
+    request_pool_refill()
+    return pool
+
+
+async def _get_own_pool(pool_id: str, wallet_id: str) -> WithdrawPool:
+    pool = await get_withdraw_pool(pool_id)
+    if not pool:
+        raise HTTPException(
+            detail="Withdraw pool does not exist.", status_code=HTTPStatus.NOT_FOUND
+        )
+    if pool.wallet != wallet_id:
+        raise HTTPException(
+            detail="Not your withdraw pool.", status_code=HTTPStatus.FORBIDDEN
+        )
+    return pool
+
+
+@withdraw_ext_api.delete("/pools/{pool_id}")
+async def api_pool_delete(
+    pool_id: str, key_info: WalletTypeInfo = Depends(require_admin_key)
+) -> SimpleStatus:
+    await _get_own_pool(pool_id, key_info.wallet.id)
+    await delete_withdraw_pool(pool_id)
+    return SimpleStatus(success=True, message="Withdraw pool deleted.")
+
+
+@withdraw_ext_api.post("/pools/{pool_id}/claim", status_code=HTTPStatus.CREATED)
+async def api_pool_claim(
+    request: Request,
+    pool_id: str,
+    data: ClaimWithdrawPoolData,
+    key_info: WalletTypeInfo = Depends(require_admin_key),
+) -> WithdrawLink:
+    pool = await _get_own_pool(pool_id, key_info.wallet.id)
+    if data.amount > pool.max_amount:
+        raise HTTPException(
+            detail=f"Amount is above the pool maximum of {pool.max_amount} sats.",
+            status_code=HTTPStatus.BAD_REQUEST,
+        )
+
+    link = await claim_pooled_withdraw_link(pool, data.amount)
+    request_pool_refill()
+    return _set_lnurl(link, request)
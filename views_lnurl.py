@@ -1,14 +1,13 @@
-import json
-from datetime import datetime
+import asyncio
+import time
+from datetime import datetime, timezone
 
-import httpx
 import shortuuid
 from bolt11 import decode as decode_bolt11
 from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse
-from lnbits.core.crud import update_payment
 from lnbits.core.models import Payment
 from lnbits.core.services import pay_invoice
+from lnbits.helpers import urlsafe_short_hash
 from lnurl import (
     CallbackUrl,
     LnurlErrorResponse,
@@ -20,26 +19,42 @@ from loguru import logger
 from pydantic import parse_obj_as
 
 from .crud import (
+    claim_withdraw_link,
+    claim_withdraw_vouchers,
     create_hash_check,
     delete_hash_check,
     get_withdraw_link_by_hash,
-    increment_withdraw_link,
+    release_withdraw_link,
+    release_withdraw_vouchers,
     remove_unique_withdraw_link,
+    withdraw_settings,
 )
-from .models import WithdrawLink
+from .deadline import (
+    CallbackDeadline,
+    DeadlineExceededError,
+    deadline_stats,
+    run_with_deadline,
+)
+from .helpers import WithdrawJSONResponse
+from .journal import record_withdraw_attempt
+from .models import SweepWithdrawData, WithdrawAttempt, WithdrawLink
+from .profiler import ProfiledRoute
+from .webhooks import queue_webhook, send_webhook
+
+withdraw_ext_lnurl = APIRouter(prefix="/api/v1/lnurl", route_class=ProfiledRoute)
 
-withdraw_ext_lnurl = APIRouter(prefix="/api/v1/lnurl")
+_webhook_tasks: set[asyncio.Task] = set()
 
 
 @withdraw_ext_lnurl.get(
     "/{unique_hash}",
-    response_class=JSONResponse,
+    response_class=WithdrawJSONResponse,
     name="withdraw.api_lnurl_response",
 )
 async def api_lnurl_response(
     request: Request, unique_hash: str
 ) -> LnurlWithdrawResponse | LnurlErrorResponse:
-    link = await get_withdraw_link_by_hash(unique_hash)
+    link = await get_withdraw_link_by_hash(unique_hash, from_replica=True)
 
     if not link:
         return LnurlErrorResponse(reason="Withdraw link does not exist.")
@@ -75,7 +90,7 @@ async def api_lnurl_response(
         This endpoints allows you to put unique_hash, k1
         and a payment_request to get your payment_request paid.
     """,
-    response_class=JSONResponse,
+    response_class=WithdrawJSONResponse,
     response_description="JSON with status",
     responses={
         200: {"description": "status: OK"},
@@ -90,14 +105,105 @@ async def api_lnurl_callback(
     pr: str,
     id_unique_hash: str | None = None,
 ) -> LnurlErrorResponse | LnurlSuccessResponse:
-    link = await get_withdraw_link_by_hash(unique_hash)
+    start = time.perf_counter()
+    deadline = CallbackDeadline(withdraw_settings.callback_deadline)
+    attempt = WithdrawAttempt(
+        id=urlsafe_short_hash(),
+        link_id="",
+        voucher_hash=id_unique_hash,
+        created_at=datetime.now(timezone.utc),
+    )
+    try:
+        response = await run_with_deadline(
+            _process_lnurl_callback(
+                unique_hash, k1, pr, id_unique_hash, attempt, deadline
+            ),
+            deadline,
+            lambda task: _record_detached_attempts([attempt], task, start),
+        )
+    except DeadlineExceededError:
+        return _deadline_exceeded([attempt], deadline, start)
+
+    _record_attempts([attempt], response, start)
+    return response
+
+
+def _deadline_exceeded(
+    attempts: list[WithdrawAttempt], deadline: CallbackDeadline, start: float
+) -> LnurlErrorResponse:
+    deadline_stats["misses"] += 1
+    # journaled by `_record_detached_attempts` once the callback finished
+    attempts[0].timings["deadline"] = round((time.perf_counter() - start) * 1000, 3)
+    return LnurlErrorResponse(
+        reason=(
+            "Withdraw is still being processed, check your wallet before retrying."
+            if deadline.committed
+            else "Withdraw timed out, please try again."
+        )
+    )
+
+
+def _record_attempts(
+    attempts: list[WithdrawAttempt],
+    response: LnurlErrorResponse | LnurlSuccessResponse,
+    start: float,
+) -> None:
+    """Journal the attempts of one callback, its stages are timed on the first."""
+    timings = {
+        **attempts[0].timings,
+        "total": round((time.perf_counter() - start) * 1000, 3),
+    }
+    for attempt in attempts:
+        attempt.timings = dict(timings)
+        if isinstance(response, LnurlErrorResponse):
+            attempt.reason = response.reason
+        else:
+            attempt.outcome = "success"
+        # unknown hashes are not journaled
+        if attempt.link_id:
+            record_withdraw_attempt(attempt)
+
+
+def _record_detached_attempts(
+    attempts: list[WithdrawAttempt],
+    task: "asyncio.Task[LnurlErrorResponse | LnurlSuccessResponse]",
+    start: float,
+) -> None:
+    """Journal a callback that outlived its deadline with its final outcome."""
+    response: LnurlErrorResponse | LnurlSuccessResponse
+    if task.cancelled():
+        response = LnurlErrorResponse(reason="Withdraw was cancelled.")
+    elif isinstance(task.exception(), DeadlineExceededError):
+        response = LnurlErrorResponse(reason="Withdraw timed out, please try again.")
+    elif task.exception():
+        response = LnurlErrorResponse(
+            reason=f"withdraw not working. {task.exception()!s}"
+        )
+    else:
+        response = task.result()
+    _record_attempts(attempts, response, start)
+
+
+async def _process_lnurl_callback(
+    unique_hash: str,
+    k1: str,
+    pr: str,
+    id_unique_hash: str | None,
+    attempt: WithdrawAttempt,
+    deadline: CallbackDeadline,
+) -> LnurlErrorResponse | LnurlSuccessResponse:
+    with attempt.stage("lookup"):
+        link = await get_withdraw_link_by_hash(unique_hash)
     if not link:
         return LnurlErrorResponse(reason="withdraw link not found.")
+    attempt.link_id = link.id
 
     if not link.enabled:
         return LnurlErrorResponse(reason="Withdraw link is disabled.")
 
-    bolt11 = decode_bolt11(pr)
+    with attempt.stage("validate"):
+        bolt11 = decode_bolt11(pr)
+    attempt.amount_msat = bolt11.amount_msat
     if not bolt11.amount_msat:
         return LnurlErrorResponse(reason="0 amount invoices are not supported.")
 
@@ -123,40 +229,200 @@ async def api_lnurl_callback(
     if not id_unique_hash and link.is_unique:
         return LnurlErrorResponse(reason="id_unique_hash is required for this link.")
 
-    if id_unique_hash:
-        if check_unique_link(link, id_unique_hash):
-            await remove_unique_withdraw_link(link, id_unique_hash)
-        else:
-            return LnurlErrorResponse(reason="id_unique_hash not found.")
+    if id_unique_hash and not check_unique_link(link, id_unique_hash):
+        return LnurlErrorResponse(reason="id_unique_hash not found.")
+
+    deadline.check()
+    claim_hash = id_unique_hash or unique_hash
+    open_time = link.open_time
+    with attempt.stage("claim"):
+        # Create a record with the id_unique_hash or unique_hash, if it already
+        # exists, raise an exception thus preventing the same LNURL from being
+        # processed twice.
+        try:
+            await create_hash_check(claim_hash, k1)
+        except Exception:
+            return LnurlErrorResponse(reason="LNURL already being processed.")
+        try:
+            claimed = await claim_withdraw_link(link, now)
+        except Exception:
+            await delete_hash_check(claim_hash)
+            raise
+        if not claimed:
+            # another callback used the link up or reset the wait time meanwhile
+            await delete_hash_check(claim_hash)
+            return LnurlErrorResponse(reason="withdraw is spent or not open yet.")
+
+    try:
+        # release the claim if the budget ran out while claiming
+        deadline.check()
+        deadline.committed = True
+        with attempt.stage("pay"):
+            payment = await pay_invoice(
+                wallet_id=link.wallet,
+                payment_request=pr,
+                max_sat=link.max_withdrawable,
+                extra={"tag": "withdraw", "withdrawal_link_id": link.id},
+            )
+    except Exception as exc:
+        # If payment fails, give back the use and delete the hash stored so
+        # another attempt can be made.
+        await release_withdraw_link(link, now, open_time)
+        await delete_hash_check(claim_hash)
+        if isinstance(exc, DeadlineExceededError):
+            raise
+        return LnurlErrorResponse(reason=f"withdraw not working. {exc!s}")
 
-    # Create a record with the id_unique_hash or unique_hash, if it already exists,
-    # raise an exception thus preventing the same LNURL from being processed twice.
     try:
-        await create_hash_check(id_unique_hash or unique_hash, k1)
-    except Exception:
-        return LnurlErrorResponse(reason="LNURL already being processed.")
+        with attempt.stage("update"):
+            if id_unique_hash:
+                # the voucher is only used up once the payment went through, its
+                # hash check is kept so the voucher can never be processed again
+                await remove_unique_withdraw_link(link, id_unique_hash)
+            else:
+                await delete_hash_check(claim_hash)
+    except Exception as exc:
+        # the payment went through and the use is already counted
+        logger.error(f"Could not update withdraw link {link.id}: {exc!s}")
+
+    if link.webhook_url:
+        _dispatch_webhook_later(link, payment, pr)
+    return LnurlSuccessResponse()
+
 
+@withdraw_ext_lnurl.post(
+    "/sweep",
+    name="withdraw.api_lnurl_sweep",
+    summary="redeem several unique vouchers with one invoice",
+    description="""
+        Claims all given unique vouchers at once and pays their combined amount
+        with a single invoice. The vouchers must belong to links of one wallet.
+    """,
+    response_class=WithdrawJSONResponse,
+)
+async def api_lnurl_sweep(
+    data: SweepWithdrawData,
+) -> LnurlErrorResponse | LnurlSuccessResponse:
+    start = time.perf_counter()
+    deadline = CallbackDeadline(withdraw_settings.callback_deadline)
+    created_at = datetime.now(timezone.utc)
+    # one journal entry per voucher
+    attempts = [
+        WithdrawAttempt(
+            id=urlsafe_short_hash(),
+            link_id="",
+            voucher_hash=voucher.id_unique_hash,
+            created_at=created_at,
+        )
+        for voucher in data.vouchers
+    ]
     try:
-        payment = await pay_invoice(
-            wallet_id=link.wallet,
-            payment_request=pr,
-            max_sat=link.max_withdrawable,
-            extra={"tag": "withdraw", "withdrawal_link_id": link.id},
+        response = await run_with_deadline(
+            _process_lnurl_sweep(data, attempts, deadline),
+            deadline,
+            lambda task: _record_detached_attempts(attempts, task, start),
         )
-        await increment_withdraw_link(link)
-        # If the payment succeeds, delete the record with the unique_hash.
-        # TODO: we delete this now: "If it has unique_hash, do not delete to prevent
-        # the same LNURL from being processed twice."
-        await delete_hash_check(id_unique_hash or unique_hash)
+    except DeadlineExceededError:
+        return _deadline_exceeded(attempts, deadline, start)
 
-        if link.webhook_url:
-            await dispatch_webhook(link, payment, pr)
-        return LnurlSuccessResponse()
+    _record_attempts(attempts, response, start)
+    return response
+
+
+async def _process_lnurl_sweep(
+    data: SweepWithdrawData,
+    attempts: list[WithdrawAttempt],
+    deadline: CallbackDeadline,
+) -> LnurlErrorResponse | LnurlSuccessResponse:
+    id_unique_hashes = [v.id_unique_hash for v in data.vouchers]
+    if len(set(id_unique_hashes)) != len(id_unique_hashes):
+        return LnurlErrorResponse(reason="Duplicate id_unique_hash.")
+
+    claims: dict[str, tuple[WithdrawLink, list[str]]] = {}
+    with attempts[0].stage("lookup"):
+        for voucher, attempt in zip(data.vouchers, attempts, strict=True):
+            if voucher.unique_hash not in claims:
+                link = await get_withdraw_link_by_hash(voucher.unique_hash)
+                if not link:
+                    return LnurlErrorResponse(reason="withdraw link not found.")
+                if not link.enabled:
+                    return LnurlErrorResponse(reason="Withdraw link is disabled.")
+                claims[voucher.unique_hash] = (link, [])
+            link, hashes = claims[voucher.unique_hash]
+            attempt.link_id = link.id
+            if not link.is_unique or not check_unique_link(
+                link, voucher.id_unique_hash
+            ):
+                return LnurlErrorResponse(reason="id_unique_hash not found.")
+            hashes.append(voucher.id_unique_hash)
+
+    links = [link for link, _ in claims.values()]
+    if len({link.wallet for link in links}) != 1:
+        return LnurlErrorResponse(reason="Vouchers must be from the same wallet.")
+
+    with attempts[0].stage("validate"):
+        bolt11 = decode_bolt11(data.pr)
+    for attempt in attempts:
+        # the invoice amount split over the vouchers it redeems
+        attempt.amount_msat = (bolt11.amount_msat or 0) // len(attempts)
+    min_msat = sum(link.min_withdrawable * 1000 * len(h) for link, h in claims.values())
+    max_sat = sum(link.max_withdrawable * len(h) for link, h in claims.values())
+    if not bolt11.amount_msat or not min_msat <= bolt11.amount_msat <= max_sat * 1000:
+        return LnurlErrorResponse(reason="Amount not within limits.")
+
+    deadline.check()
+    now = int(datetime.now().timestamp())
+    with attempts[0].stage("claim"):
+        claimed = await claim_withdraw_vouchers(list(claims.values()), now)
+    if not claimed:
+        return LnurlErrorResponse(
+            reason="Vouchers already being processed, spent or not open yet."
+        )
+
+    try:
+        # release the claims if the budget ran out while claiming
+        deadline.check()
+        deadline.committed = True
+        with attempts[0].stage("pay"):
+            payment = await pay_invoice(
+                wallet_id=links[0].wallet,
+                payment_request=data.pr,
+                max_sat=max_sat,
+                extra={
+                    "tag": "withdraw",
+                    "withdrawal_link_id": links[0].id,
+                    "withdrawal_link_ids": [link.id for link in links],
+                    "vouchers": len(id_unique_hashes),
+                },
+            )
     except Exception as exc:
-        # If payment fails, delete the hash stored so another attempt can be made.
-        await delete_hash_check(id_unique_hash or unique_hash)
+        await release_withdraw_vouchers(list(claims.values()), now)
+        if isinstance(exc, DeadlineExceededError):
+            raise
         return LnurlErrorResponse(reason=f"withdraw not working. {exc!s}")
 
+    with attempts[0].stage("update"):
+        for link, hashes in claims.values():
+            try:
+                await remove_unique_withdraw_link(link, *hashes)
+            except Exception as exc:
+                # the payment went through and the uses are already counted
+                logger.error(f"Could not update withdraw link {link.id}: {exc!s}")
+    for link, _ in claims.values():
+        if link.webhook_url:
+            _dispatch_webhook_later(link, payment, data.pr)
+    return LnurlSuccessResponse()
+
+
+def _dispatch_webhook_later(link: WithdrawLink, payment: Payment, pr: str) -> None:
+    if link.webhook_digest:
+        queue_webhook(link, payment, pr)
+        return
+    # sent after the response, the webhook can take up to 40 seconds
+    task = asyncio.create_task(dispatch_webhook(link, payment, pr))
+    _webhook_tasks.add(task)
+    task.add_done_callback(_webhook_tasks.discard)
+
 
 def check_unique_link(link: WithdrawLink, unique_hash: str) -> bool:
     return any(
@@ -168,44 +434,19 @@ def check_unique_link(link: WithdrawLink, unique_hash: str) -> bool:
 async def dispatch_webhook(
     link: WithdrawLink, payment: Payment, payment_request: str
 ) -> None:
-    async with httpx.AsyncClient() as client:
-        try:
-            r: httpx.Response = await client.post(
-                link.webhook_url,
-                json={
-                    "payment_hash": payment.payment_hash,
-                    "payment_request": payment_request,
-                    "lnurlw": link.id,
-                    "body": json.loads(link.webhook_body) if link.webhook_body else "",
-                },
-                headers=(
-                    json.loads(link.webhook_headers) if link.webhook_headers else None
-                ),
-                timeout=40,
-            )
-            payment.extra["wh_success"] = r.is_success
-            payment.extra["wh_message"] = r.reason_phrase
-            payment.extra["wh_response"] = r.text
-            await update_payment(payment)
-        except Exception as exc:
-            # webhook fails shouldn't cause the lnurlw to fail
-            # since invoice is already paid
-            logger.error(f"Caught exception when dispatching webhook url: {exc!s}")
-            payment.extra["wh_success"] = False
-            payment.extra["wh_message"] = str(exc)
-            await update_payment(payment)
+    await send_webhook(link, [(payment, payment_request)])
 
 
 # FOR LNURLs WHICH ARE UNIQUE
 @withdraw_ext_lnurl.get(
     "/{unique_hash}/{id_unique_hash}",
-    response_class=JSONResponse,
+    response_class=WithdrawJSONResponse,
     name="withdraw.api_lnurl_multi_response",
 )
 async def api_lnurl_multi_response(
     request: Request, unique_hash: str, id_unique_hash: str
 ) -> LnurlWithdrawResponse | LnurlErrorResponse:
-    link = await get_withdraw_link_by_hash(unique_hash)
+    link = await get_withdraw_link_by_hash(unique_hash, from_replica=True)
 
     if not link:
         return LnurlErrorResponse(reason="Withdraw link does not exist.")
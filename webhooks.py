@@ -0,0 +1,126 @@
+import asyncio
+import json
+import time
+from contextlib import suppress
+from dataclasses import dataclass, field
+
+import httpx
+from lnbits.core.crud import update_payment
+from lnbits.core.models import Payment
+from loguru import logger
+
+from .crud import chunks, withdraw_settings
+from .models import WithdrawLink
+
+# seconds between two checks for digests that are due
+CHECK_INTERVAL = 1
+
+
+@dataclass
+class WebhookDigest:
+    link: WithdrawLink
+    started: float = field(default_factory=time.monotonic)
+    events: list[tuple[Payment, str]] = field(default_factory=list)
+
+
+# pending digests by link id, filled by `queue_webhook`
+_digests: dict[str, WebhookDigest] = {}
+_flush_event = asyncio.Event()
+
+
+async def send_webhook(
+    link: WithdrawLink, events: list[tuple[Payment, str]], digest: bool = False
+) -> None:
+    """
+    POST the payments to the link's webhook, one per request or all of them as
+    a digest, and record the outcome on every payment.
+    """
+    entries = [
+        {
+            "payment_hash": payment.payment_hash,
+            "payment_request": payment_request,
+            "lnurlw": link.id,
+        }
+        for payment, payment_request in events
+    ]
+    try:
+        # a bad stored body or header is recorded on the payments like any
+        # other webhook failure
+        body = json.loads(link.webhook_body) if link.webhook_body else ""
+        if digest:
+            content = {"lnurlw": link.id, "body": body, "payments": entries}
+        else:
+            content = {**entries[0], "body": body}
+        async with httpx.AsyncClient() as client:
+            r: httpx.Response = await client.post(
+                link.webhook_url,
+                json=content,
+                headers=(
+                    json.loads(link.webhook_headers) if link.webhook_headers else None
+                ),
+                timeout=40,
+            )
+        extra = {
+            "wh_success": r.is_success,
+            "wh_message": r.reason_phrase,
+            "wh_response": r.text,
+        }
+    except Exception as exc:
+        # webhook fails shouldn't cause the lnurlw to fail
+        # since invoice is already paid
+        logger.error(f"Caught exception when dispatching webhook url: {exc!s}")
+        extra = {"wh_success": False, "wh_message": str(exc)}
+    for payment, _ in events:
+        payment.extra.update(extra)
+        await update_payment(payment)
+
+
+def queue_webhook(link: WithdrawLink, payment: Payment, payment_request: str) -> None:
+    """Add the payment to the link's next digest."""
+    digest = _digests.get(link.id)
+    if not digest:
+        digest = _digests[link.id] = WebhookDigest(link)
+    # the latest copy of the link, in case its webhook was edited meanwhile
+    digest.link = link
+    digest.events.append((payment, payment_request))
+    if len(digest.events) >= withdraw_settings.webhook_digest_size:
+        _flush_event.set()
+
+
+async def flush_webhook_digests(flush_all: bool = False) -> int:
+    """
+    Send the full digests, and all events that waited for the interval.
+    Returns the number of digests sent.
+    """
+    size = withdraw_settings.webhook_digest_size
+    oldest = time.monotonic() - withdraw_settings.webhook_digest_interval
+    sends = []
+    for link_id, digest in list(_digests.items()):
+        if flush_all or digest.started <= oldest:
+            count = len(digest.events)
+        else:
+            count = len(digest.events) // size * size
+        if not count:
+            continue
+        events, digest.events = digest.events[:count], digest.events[count:]
+        if not digest.events:
+            del _digests[link_id]
+        for chunk in chunks(events, size):
+            sends.append(send_webhook(digest.link, chunk, digest=True))
+    for result in await asyncio.gather(*sends, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error(f"Could not record webhook digest: {result!s}")
+    return len(sends)
+
+
+async def run_webhook_digests() -> None:
+    try:
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(_flush_event.wait(), CHECK_INTERVAL)
+            _flush_event.clear()
+            await flush_webhook_digests()
+    except asyncio.CancelledError:
+        with suppress(Exception):
+            await flush_webhook_digests(flush_all=True)
+        raise